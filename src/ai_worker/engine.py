@@ -0,0 +1,149 @@
+"""
+vLLM engine setup for the AI worker.
+
+The engine is created lazily by get_llm() and cached, so importing this module
+(or main.py) never touches CUDA; the model is loaded once per process on the
+first call.
+"""
+import os
+from functools import lru_cache
+
+# CRITICAL: Force v0 API - Must set env var BEFORE importing vLLM!
+# vLLM decides v0/v1 at import time, so this must be set before import
+os.environ["VLLM_USE_V1"] = "0"
+# Compile/autotune caches are also resolved at import time; keep them on a
+# persistent volume so restarts skip the kernel tuning
+os.environ.setdefault("VLLM_CACHE_ROOT", "/var/cache/vllm")
+
+from vllm import LLM, SamplingParams
+from common.utils import setup_logging
+from common.ai_worker_utils import (
+    get_gpu_memory_gb,
+    get_gpu_compute_capability,
+    supports_fp8,
+    select_model_by_vram,
+    infer_quantization,
+    get_rope_scaling,
+)
+
+logger = setup_logging("ai_worker.engine")
+logger.info("🔒 Forced VLLM_USE_V1=0 (before vLLM import)")
+
+
+def resolve_model():
+    """
+    Resolve model, quantization and max length from env or GPU VRAM.
+
+    Returns:
+        Tuple of (model_name, quantization, max_model_len)
+    """
+    # Check if model is specified via environment variable
+    env_model = os.getenv("VLLM_MODEL")
+
+    if env_model:
+        # Use explicitly specified model
+        logger.info("📋 Using model from environment: %s", env_model)
+        quantization = os.getenv("VLLM_QUANTIZATION") or infer_quantization(env_model)
+        if quantization is None:
+            logger.warning(
+                "⚠️  %s looks unquantized: full-precision weights need "
+                "~2 bytes/param and won't fit a 12GB GPU for 7B+ models", env_model,
+            )
+        return env_model, quantization, int(os.getenv("VLLM_MAX_MODEL_LEN", "4096"))
+
+    # Auto-select model based on GPU VRAM
+    gpu_memory = get_gpu_memory_gb()
+    if gpu_memory:
+        logger.info("🎮 Detected GPU VRAM: %.1f GB", gpu_memory)
+        fp8_supported = supports_fp8(get_gpu_compute_capability())
+        model_name, quantization, max_model_len = select_model_by_vram(
+            gpu_memory, fp8_supported=fp8_supported
+        )
+        logger.info("🤖 Auto-selected model: %s", model_name)
+        return model_name, quantization, max_model_len
+
+    # Fallback to default (safe for most GPUs)
+    logger.warning("⚠️  Could not detect GPU VRAM, using default model")
+    return "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 4096
+
+
+@lru_cache(maxsize=1)
+def get_llm():
+    """
+    Build the vLLM engine on first call and return the same instance afterwards.
+
+    Returns:
+        vLLM LLM instance
+    """
+    logger.info("🔧 Initializing vLLM Engine...")
+    model_name, quantization, max_model_len = resolve_model()
+
+    gpu_memory_util = float(os.getenv("VLLM_GPU_MEMORY_UTILIZATION", "0.90"))
+    # AWQ kernels require FP16; FP8 checkpoints use their own activation dtype
+    dtype = "half" if quantization == "awq" else "auto"
+    # FP8 KV cache halves KV bandwidth/memory (default for FP8 checkpoints)
+    kv_cache_dtype = os.getenv(
+        "VLLM_KV_CACHE_DTYPE", "fp8_e4m3" if quantization == "fp8" else "auto"
+    )
+    # Reuse KV cache blocks for the shared system prompt / chat template prefix
+    enable_prefix_caching = os.getenv("VLLM_ENABLE_PREFIX_CACHING", "1") == "1"
+    # CUDA graphs for decode; the RoPE scaling issue that required eager
+    # mode is handled by the explicit rope_scaling override below.
+    # VLLM_ENFORCE_EAGER=1 falls back to eager mode.
+    enforce_eager = os.getenv("VLLM_ENFORCE_EAGER", "0") == "1"
+    rope_scaling = get_rope_scaling(model_name)
+    # Caps concurrent sequences (and the CUDA graph batch sizes captured)
+    max_num_seqs = int(os.getenv("VLLM_MAX_NUM_SEQS", "32"))
+    # Split layer weights across GPUs on multi-GPU nodes (frees KV cache room)
+    tensor_parallel_size = int(os.getenv("VLLM_TP", "1"))
+    # Weights directory (defaults to the HuggingFace cache)
+    download_dir = os.getenv("VLLM_DOWNLOAD_DIR") or None
+
+    # Environment check (for debugging)
+    logger.info("🔍 Environment Check:")
+    logger.info("   VLLM_USE_V1=%s", os.getenv("VLLM_USE_V1"))
+    logger.info("   Model: %s", model_name)
+
+    try:
+        llm = LLM(
+            model=model_name,
+            quantization=quantization,  # AWQ (INT4 weight-only) or FP8 (W8A8)
+            gpu_memory_utilization=gpu_memory_util,
+            max_model_len=max_model_len,
+            trust_remote_code=True,  # Required for some models
+            dtype=dtype,
+            kv_cache_dtype=kv_cache_dtype,
+            enforce_eager=enforce_eager,
+            rope_scaling=rope_scaling,
+            max_num_seqs=max_num_seqs,
+            tensor_parallel_size=tensor_parallel_size,
+            enable_prefix_caching=enable_prefix_caching,
+            download_dir=download_dir,
+        )
+    except Exception as e:
+        logger.exception(
+            "❌ Failed to load vLLM model %s (quantization=%s, VLLM_USE_V1=%s): %s",
+            model_name, quantization, os.getenv("VLLM_USE_V1"), e,
+        )
+        logger.error("💡 Tip: For RTX 4070 (12GB), use AWQ 4-bit quantized models")
+        raise
+
+    logger.info("✅ vLLM Model Loaded: %s", model_name)
+    logger.info("   Quantization: %s", (quantization or "none").upper())
+    logger.info("   KV Cache dtype: %s", kv_cache_dtype)
+    logger.info("   GPU Memory Utilization: %s%%", gpu_memory_util * 100)
+    logger.info("   Max Model Length: %s tokens", max_model_len)
+    logger.info("   Prefix Caching: %s", "ON" if enable_prefix_caching else "OFF")
+    logger.info("   CUDA Graphs: %s", "OFF (eager)" if enforce_eager else "ON")
+    logger.info("   RoPE scaling override: %s", rope_scaling)
+    logger.info("   Max Num Seqs: %d", max_num_seqs)
+    logger.info("   Tensor Parallel: %d", tensor_parallel_size)
+    logger.info("   Cache root: %s", os.environ["VLLM_CACHE_ROOT"])
+
+    # Warm up so the first real request doesn't pay kernel/graph setup cost;
+    # doubles as a smoke test of the captured graphs
+    warmup = llm.generate(["warmup"], SamplingParams(max_tokens=8), use_tqdm=False)
+    if not warmup[0].outputs[0].token_ids:
+        logger.warning("⚠️  Warmup produced no tokens; try VLLM_ENFORCE_EAGER=1")
+    logger.info("🔥 vLLM warmup done")
+    return llm
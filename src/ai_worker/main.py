@@ -1,91 +1,26 @@
-import os
-from datetime import datetime
-import time as time_module
-
-# CRITICAL: Force v0 API - Must set env var BEFORE importing vLLM!
-# vLLM decides v0/v1 at import time, so this must be set before import
-os.environ["VLLM_USE_V1"] = "0"
-print("🔒 Forced VLLM_USE_V1=0 (before vLLM import)")
-
-from vllm import LLM, SamplingParams
-from sqlalchemy import text
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+import time
+
+from engine import get_llm
+from vllm import SamplingParams
+from sqlalchemy import func, select, text
 from common.config import settings
-from common.utils import KafkaConsumerWrapper
+from common.utils import KafkaConsumerWrapper, setup_logging
 from common.database import SessionLocal, Request, AnalysisResult, SearchResult
-from common.ai_worker_utils import get_gpu_memory_gb, select_model_by_vram
-
-
-# Initialize vLLM model (Global - only once at program start)
-print("🔧 Initializing vLLM Engine...")
-
-# Check if model is specified via environment variable
-env_model = os.getenv("VLLM_MODEL")
-
-if env_model:
-    # Use explicitly specified model
-    MODEL_NAME = env_model
-    QUANTIZATION = os.getenv("VLLM_QUANTIZATION", "awq")
-    MAX_MODEL_LEN = int(os.getenv("VLLM_MAX_MODEL_LEN", "4096"))
-    print(f"📋 Using model from environment: {MODEL_NAME}")
-else:
-    # Auto-select model based on GPU VRAM
-    gpu_memory = get_gpu_memory_gb()
-    if gpu_memory:
-        print(f"🎮 Detected GPU VRAM: {gpu_memory:.1f} GB")
-        MODEL_NAME, QUANTIZATION, MAX_MODEL_LEN = select_model_by_vram(gpu_memory)
-        print(f"🤖 Auto-selected model: {MODEL_NAME}")
-    else:
-        # Fallback to default (safe for most GPUs)
-        print("⚠️  Could not detect GPU VRAM, using default model")
-        MODEL_NAME = "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4"
-        QUANTIZATION = "awq"
-        MAX_MODEL_LEN = 4096
-
-GPU_MEMORY_UTIL = float(os.getenv("VLLM_GPU_MEMORY_UTILIZATION", "0.90"))
-
-# Environment check (for debugging)
-print(f"🔍 Environment Check:")
-print(f"   VLLM_USE_V1={os.getenv('VLLM_USE_V1')}")
-print(f"   Model: {MODEL_NAME}")
-
-try:
-    llm = LLM(
-        model=MODEL_NAME,
-        quantization=QUANTIZATION,  # Enable AWQ quantization
-        gpu_memory_utilization=GPU_MEMORY_UTIL,
-        max_model_len=MAX_MODEL_LEN,
-        trust_remote_code=True,  # Required for some models
-        dtype="half",  # Use FP16
-        enforce_eager=True,  # Disable CUDA graph (fixes RoPE scaling issues)
-    )
-    print(f"✅ vLLM Model Loaded: {MODEL_NAME}")
-    print(f"   Quantization: {QUANTIZATION.upper()}")
-    print(f"   GPU Memory Utilization: {GPU_MEMORY_UTIL * 100}%")
-    print(f"   Max Model Length: {MAX_MODEL_LEN} tokens")
-except Exception as e:
-    print(f"❌ Failed to load vLLM model: {e}")
-    print(f"💡 Model: {MODEL_NAME}")
-    print(f"💡 Quantization: {QUANTIZATION}")
-    print(f"💡 VLLM_USE_V1: {os.getenv('VLLM_USE_V1')}")
-    print("💡 Tip: For RTX 4070 (12GB), use AWQ 4-bit quantized models")
-    import traceback
-    traceback.print_exc()
-    raise
+from common.ai_worker_utils import (
+    CONTEXT_SEPARATOR,
+    format_search_result,
+    rank_sentences,
+    adaptive_max_tokens,
+    pack_chunks,
+)
 
+logger = setup_logging("ai_worker")
 
-def generate_search_queries(topic, llm, max_queries=5):
-    """
-    Phase 1: Generate diverse search queries for a given topic
-    
-    Args:
-        topic: User's search topic
-        llm: vLLM instance
-        max_queries: Maximum number of queries to generate
-        
-    Returns:
-        List of search query strings
-    """
-    system_prompt = """You are a search query generator.
+
+QUERY_SYSTEM_PROMPT = """You are a search query generator.
 
 Generate 3-5 diverse search queries in Korean to comprehensively research the topic.
 
@@ -95,17 +30,43 @@ Rules:
 3. One query per line
 4. No numbering, bullets, or extra formatting"""
 
-    user_prompt = f"""Topic: {topic}
+# Llama 3.1 Chat Template, split into the static system block (tokenized once,
+# see query_prefix_ids) and the per-topic user/assistant turn
+QUERY_PROMPT_PREFIX = (
+    "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
+    + QUERY_SYSTEM_PROMPT
+    + "<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n"
+)
 
-Generate 3-5 diverse search queries:"""
+QUERY_USER_TEMPLATE = (
+    "Topic: {topic}\n\n"
+    "Generate 3-5 diverse search queries:"
+    "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+)
 
-    prompt = f"""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
 
-{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>
+@lru_cache(maxsize=1)
+def query_prefix_ids(tokenizer):
+    """Token ids of QUERY_PROMPT_PREFIX"""
+    return tokenizer.encode(QUERY_PROMPT_PREFIX, add_special_tokens=False)
 
-{user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
 
-"""
+def generate_search_queries(topic, llm, max_queries=5):
+    """
+    Phase 1: Generate diverse search queries for a given topic
+    
+    Args:
+        topic: User's search topic
+        llm: vLLM instance
+        max_queries: Maximum number of queries to generate
+        
+    Returns:
+        List of search query strings
+    """
+    tokenizer = llm.get_tokenizer()
+    prompt_ids = query_prefix_ids(tokenizer) + tokenizer.encode(
+        QUERY_USER_TEMPLATE.format(topic=topic), add_special_tokens=False
+    )
 
     sampling_params = SamplingParams(
         temperature=0.8,  # Higher for diversity
@@ -114,150 +75,195 @@ Generate 3-5 diverse search queries:"""
         stop=["\n\n"]
     )
 
-    print("🧠 Generating search queries...")
-    outputs = llm.generate([prompt], sampling_params)
+    logger.info("🧠 Generating search queries...")
+    outputs = llm.generate([{"prompt_token_ids": prompt_ids}], sampling_params)
     queries_text = outputs[0].outputs[0].text.strip()
     
     # Split by newlines and clean
     queries = [q.strip() for q in queries_text.split('\n') if q.strip()]
     queries = queries[:max_queries]
     
-    print(f"✅ Generated {len(queries)} queries:")
-    for idx, q in enumerate(queries, 1):
-        print(f"   {idx}. {q}")
+    logger.info("✅ Generated %d queries: %s", len(queries), queries)
     
     return queries
 
 
-def analyze_search_results(request_id, topic, db, llm):
+def load_search_results(request_id, db):
     """
-    Phase 2: Analyze search results and generate summary
-    Uses Map-Reduce if context exceeds limit.
+    Load search results for a request as plain dicts.
+    Plain dicts (not ORM objects) can be handed to the inference thread safely.
 
     Args:
         request_id: UUID of the request
-        topic: Original user topic
         db: Database session
-        llm: vLLM instance
-        
+
     Returns:
-        tuple: (summary_text, inference_time_ms)
+        List of dicts with keys: title, url, content
     """
-    start_time = time_module.time()
-    
-    # Get search results from DB
-    db_request = db.query(Request).filter(Request.id == request_id).first()
-    search_results = db_request.search_results
-    
+    # Column-only Core select: no ORM identity map / object hydration.
+    # Content is truncated by Postgres, so only the prefix BM25 ranking can
+    # use is sent over the wire and materialized as a Python str
+    rows = db.execute(
+        select(
+            SearchResult.title,
+            SearchResult.url,
+            func.substr(SearchResult.content, 1, settings.AI_MAX_SOURCE_CHARS).label("content"),
+        )
+        .where(SearchResult.request_id == request_id)
+        .order_by(SearchResult.id)
+    )
+    search_results = [dict(row) for row in rows.mappings()]
+
     if not search_results:
         raise ValueError(f"No search results found for request {request_id}")
-    
-    print(f"📚 Found {len(search_results)} search results")
-    
-    # 1. Initialize Tokenizer & Constants
-    tokenizer = llm.get_tokenizer()
-    
+
+    logger.info("📚 Found %d search results", len(search_results))
+    return search_results
+
+
+def plan_analysis_context(topic, search_results, tokenizer, max_model_len):
+    """
+    Phase 2 (prepare): Decide how the final analysis context is built.
+    Uses Map-Reduce if context exceeds limit; the Map prompts of a whole
+    micro-batch are then generated together in run_inference().
+
+    Args:
+        topic: Original user topic
+        search_results: List of dicts from load_search_results()
+        tokenizer: vLLM tokenizer
+        max_model_len: Model context length
+
+    Returns:
+        (context_parts, map_prompts): context_parts ("[결과 N]" items in rank
+        order) when the results fit directly, otherwise map_prompts
+        ({"prompt_token_ids": ...} dicts) for the Map phase (context_parts
+        is then None)
+    """
+    # 1. Constants
     # Reserve tokens:
     # System Prompt (~200) + User Template (~100) + Output Buffer (~1500) = ~1800
-    # Safe Context Limit = MAX_MODEL_LEN - 1800
+    # Safe Context Limit = max_model_len - 1800
     RESERVED_TOKENS = 1800
-    MAX_CONTEXT_TOKENS = MAX_MODEL_LEN - RESERVED_TOKENS
+    MAX_CONTEXT_TOKENS = max_model_len - RESERVED_TOKENS
     
-    # Chunk size for "Map" phase (smaller to fit multiple chunks if needed, or just safe margin)
-    # If we map, we want chunks to be well within limits.
-    MAP_CHUNK_SIZE = 3000 
+    # Chunk size for "Map" phase: ~3/4 of the context budget packs results
+    # densely (fewer Map calls) while leaving room for the Map output
+    MAP_CHUNK_SIZE = int(MAX_CONTEXT_TOKENS * 0.75)
     
-    # 2. Prepare content items
-    content_items = []
-    for idx, result in enumerate(search_results, 1):
-        # Format: "[Result N] Title: ... Content: ..."
-        content = result.content[:10000] if result.content else "" # Hard cap just in case
-        text_item = (
-            f"[결과 {idx}]\n"
-            f"제목: {result.title}\n"
-            f"URL: {result.url}\n"
-            f"내용: {content}\n"
-        )
-        content_items.append(text_item)
+    # 2. Prepare content items ("[결과 N] 제목/URL/내용")
+    # Long pages are compressed to their most topic-relevant sentences first,
+    # so prefill is not spent on low-signal text
+    content_items = [
+        format_search_result(idx, {
+            **result,
+            "content": rank_sentences(result["content"], topic, settings.AI_MAX_CONTENT_CHARS),
+        })
+        for idx, result in enumerate(search_results, 1)
+    ]
         
     # 3. Calculate total tokens
-    full_context_str = "\n---\n".join(content_items)
-    total_tokens = len(tokenizer.encode(full_context_str))
-    
-    print(f"📊 Total Context Tokens: {total_tokens} (Limit: {MAX_CONTEXT_TOKENS})")
+    # One batched (Rust-side) encode for all items; the joined context length
+    # is derived from the item lengths instead of encoding it again
+    item_lens = [
+        len(ids) for ids in tokenizer(content_items, add_special_tokens=False)["input_ids"]
+    ]
+    sep_len = len(tokenizer.encode(CONTEXT_SEPARATOR, add_special_tokens=False))
+    total_tokens = sum(item_lens) + sep_len * (len(content_items) - 1)
     
-    final_context = ""
+    logger.info("📊 Total Context Tokens: %d (Limit: %d)", total_tokens, MAX_CONTEXT_TOKENS)
     
     # 4. Strategy Selection
     if total_tokens <= MAX_CONTEXT_TOKENS:
         # --- STRATEGY A: Direct Analysis (Fits in context) ---
-        print("✅ Context fits in limit. Proceeding with direct analysis.")
-        final_context = full_context_str
-        
-    else:
-        # --- STRATEGY B: Map-Reduce ---
-        print("⚠️  Context exceeds limit. Triggering Map-Reduce...")
-        
-        # [Map Phase] Split into chunks and summarize individually
-        chunks = []
-        current_chunk = []
-        current_tokens = 0
-        
-        for item in content_items:
-            item_tokens = len(tokenizer.encode(item))
-            
-            # If a single item is too huge, truncate it (rare but possible)
-            if item_tokens > MAP_CHUNK_SIZE:
-                # Naive truncation for simple safety
-                ratio = MAP_CHUNK_SIZE / item_tokens
-                cut_len = int(len(item) * ratio)
-                item = item[:cut_len] + "...(truncated)"
-                item_tokens = MAP_CHUNK_SIZE
-            
-            if current_tokens + item_tokens > MAP_CHUNK_SIZE:
-                # Finalize current chunk
-                chunks.append("\n---\n".join(current_chunk))
-                current_chunk = [item]
-                current_tokens = item_tokens
-            else:
-                current_chunk.append(item)
-                current_tokens += item_tokens
-        
-        if current_chunk:
-            chunks.append("\n---\n".join(current_chunk))
-            
-        print(f"🧩 Split into {len(chunks)} chunks for parallel summarization.")
-        
-        # Generate summaries for each chunk in parallel
-        map_prompts = []
-        map_system_prompt = "You are a research assistant. Summarize the provided search results in Korean. Extract key facts relevant to the topic."
-        
-        for i, chunk in enumerate(chunks, 1):
-            user_msg = f"Topic: {topic}\n\nChunk {i}/{len(chunks)}:\n{chunk}\n\nSummarize key points in Korean:"
-            # Construct prompt for this chunk
-            p = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{map_system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{user_msg}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
-            map_prompts.append(p)
-            
-        print(f"🚀 Running batch inference for {len(chunks)} chunks...")
-        
-        # Use slightly more aggressive params for speed
-        map_params = SamplingParams(temperature=0.7, max_tokens=1024)
-        map_outputs = llm.generate(map_prompts, map_params)
-        
-        intermediate_summaries = []
-        for output in map_outputs:
-            intermediate_summaries.append(output.outputs[0].text.strip())
-            
-        # [Reduce Phase] Combine summaries
-        print("🔗 Combining intermediate summaries...")
-        combined_summaries = "\n\n---\n\n".join([f"Summary Part {i+1}:\n{s}" for i, s in enumerate(intermediate_summaries)])
+        logger.info("✅ Context fits in limit. Proceeding with direct analysis.")
+        return content_items, None
+
+    # --- STRATEGY B: Map-Reduce ---
+    logger.info("⚠️  Context exceeds limit. Triggering Map-Reduce...")
+    
+    # [Map Phase] Split into chunks and summarize individually
+    for i, item_tokens in enumerate(item_lens):
+        # If a single item is too huge, truncate it (rare but possible)
+        if item_tokens > MAP_CHUNK_SIZE:
+            # Naive truncation for simple safety
+            cut_len = int(len(content_items[i]) * MAP_CHUNK_SIZE / item_tokens)
+            content_items[i] = content_items[i][:cut_len] + "...(truncated)"
+            item_lens[i] = MAP_CHUNK_SIZE
+
+    # Pack by token counts first, join each chunk's items once
+    chunks = [
+        CONTEXT_SEPARATOR.join(content_items[j] for j in indices)
+        for indices in pack_chunks(item_lens, MAP_CHUNK_SIZE, sep_len)
+    ]
         
-        final_context = combined_summaries
-        print(f"📉 Reduced Context Tokens: {len(tokenizer.encode(final_context))}")
+    if len(chunks) == 1:
+        # Everything fits one chunk (e.g. one oversize result was truncated):
+        # a Map pass would only add a second generate, run the final pass on it
+        logger.info("✅ Single chunk after truncation. Proceeding with direct analysis.")
+        return chunks, None
 
-    # 5. Final Analysis
-    # System prompt for analysis
-    system_prompt = """You are a professional information summarization assistant.
+    logger.info("🧩 Split into %d chunks for parallel summarization.", len(chunks))
+    
+    # Pre-tokenized Map prompts: cached shared prefix + batch-encoded user parts
+    prefix_ids = map_prefix_ids(tokenizer)
+    user_parts = [
+        MAP_USER_TEMPLATE.format(topic=topic, index=i, total=len(chunks), chunk=chunk)
+        for i, chunk in enumerate(chunks, 1)
+    ]
+    map_prompts = [
+        {"prompt_token_ids": prefix_ids + ids}
+        for ids in tokenizer(user_parts, add_special_tokens=False)["input_ids"]
+    ]
+    return None, map_prompts
+
+
+def build_final_prompt_ids(topic, context_parts, context_separator, tokenizer, max_model_len):
+    """
+    Phase 2 (prepare): Tokenize the final analysis prompt.
+    The final pass itself is batched across requests in analyze_batch().
+
+    Args:
+        topic: Original user topic
+        context_parts: Search result items or partial summaries, in rank order
+        context_separator: Separator placed between context parts
+        tokenizer: vLLM tokenizer
+        max_model_len: Model context length
+
+    Returns:
+        list[int]: Token ids of the prompt for the final analysis pass
+    """
+    # Pre-tokenize so vLLM skips its own encode on the scheduling path;
+    # only the per-request user turn is encoded here
+    prompt_ids = build_analysis_prompt_ids(
+        topic, context_separator.join(context_parts), tokenizer
+    )
+
+    # Bail out before vLLM rejects an oversize prompt: drop the lowest-ranked
+    # parts from the tail until prompt + output fits the model length
+    budget = max_model_len - ANALYSIS_SAMPLING_PARAMS.max_tokens
+    if len(prompt_ids) > budget:
+        overflow = len(prompt_ids) - budget
+        kept = list(context_parts)
+        while overflow > 0 and len(kept) > 1:
+            overflow -= len(tokenizer.encode(kept.pop(), add_special_tokens=False))
+
+        logger.warning(
+            "✂️  Prompt exceeds budget (%d > %d tokens), dropped %d of %d context part(s)",
+            len(prompt_ids), budget, len(context_parts) - len(kept), len(context_parts),
+        )
+        prompt_ids = build_analysis_prompt_ids(
+            topic, context_separator.join(kept), tokenizer
+        )
+        if len(prompt_ids) > budget:
+            raise ValueError(
+                f"Analysis prompt too long: {len(prompt_ids)} tokens (budget {budget})"
+            )
+
+    return prompt_ids
+
+
+# System prompt for analysis
+ANALYSIS_SYSTEM_PROMPT = """You are a professional information summarization assistant.
 
 CRITICAL RULES:
 1. Respond in Korean language ONLY (한국어로만 답변)
@@ -269,147 +275,496 @@ CRITICAL RULES:
 
 Your response must be entirely in Korean."""
 
-    user_prompt = f"""Topic: {topic}
+# Llama 3.1 Chat Template, built once. The system block is an identical token
+# prefix across requests (tokenized once, see analysis_prefix_ids), which
+# keeps vLLM prefix cache hits reliable.
+ANALYSIS_PROMPT_PREFIX = (
+    "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
+    + ANALYSIS_SYSTEM_PROMPT
+    + "<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n"
+)
+
+ANALYSIS_USER_TEMPLATE = (
+    "Topic: {topic}\n\n"
+    "Search Results (or Summarized Context):\n"
+    "{context}\n\n"
+    "Summarize the above information about '{topic}' in Korean language."
+    "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+)
+
+MAP_SYSTEM_PROMPT = "You are a research assistant. Summarize the provided search results in Korean. Extract key facts relevant to the topic."
+
+# Static part shared by every Map prompt; tokenized once (map_prefix_ids)
+MAP_PROMPT_PREFIX = (
+    "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
+    + MAP_SYSTEM_PROMPT
+    + "<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n"
+)
+
+MAP_USER_TEMPLATE = (
+    "Topic: {topic}\n\n"
+    "Chunk {index}/{total}:\n{chunk}\n\n"
+    "Summarize key points in Korean:"
+    "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+)
+
+
+@lru_cache(maxsize=1)
+def map_prefix_ids(tokenizer):
+    """Token ids of MAP_PROMPT_PREFIX (ends in "\n\n", so it splits cleanly)"""
+    return tokenizer.encode(MAP_PROMPT_PREFIX, add_special_tokens=False)
+
+
+# Map phase sampling params (slightly more aggressive for speed); max_tokens
+# is the cap, each chunk gets a budget scaled to its size
+MAP_SAMPLING_PARAMS = SamplingParams(temperature=0.7, max_tokens=1024)
+
+
+def map_sampling_params(n_prompt_tokens):
+    """Per-chunk copy of MAP_SAMPLING_PARAMS with a prompt-scaled max_tokens"""
+    params = MAP_SAMPLING_PARAMS.clone()
+    params.max_tokens = adaptive_max_tokens(
+        n_prompt_tokens, cap=MAP_SAMPLING_PARAMS.max_tokens, base=256
+    )
+    return params
+
 
-Search Results (or Summarized Context):
-{final_context}
+@lru_cache(maxsize=1)
+def analysis_prefix_ids(tokenizer):
+    """Token ids of ANALYSIS_PROMPT_PREFIX"""
+    return tokenizer.encode(ANALYSIS_PROMPT_PREFIX, add_special_tokens=False)
 
-Summarize the above information about '{topic}' in Korean language."""
 
-    # Llama 3.1 Chat Template
-    prompt = f"""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+def build_analysis_prompt_ids(topic, context, tokenizer):
+    """Token ids of the Llama 3.1 chat prompt for the final analysis pass"""
+    return analysis_prefix_ids(tokenizer) + tokenizer.encode(
+        ANALYSIS_USER_TEMPLATE.format(topic=topic, context=context),
+        add_special_tokens=False,
+    )
 
-{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>
 
-{user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+# Analysis sampling params (Final Pass); max_tokens is the cap, each request
+# gets an adaptive budget via analysis_sampling_params()
+ANALYSIS_SAMPLING_PARAMS = SamplingParams(
+    temperature=0.7,
+    top_p=0.9,
+    max_tokens=1536,
+    repetition_penalty=1.1,
+    frequency_penalty=0.2
+)
 
-"""
 
-    # Analysis sampling params
-    sampling_params = SamplingParams(
-        temperature=0.7,
-        top_p=0.9,
-        max_tokens=1536,
-        repetition_penalty=1.1,
-        frequency_penalty=0.2
+def analysis_sampling_params(n_prompt_tokens, stop_token_ids):
+    """Per-request copy of ANALYSIS_SAMPLING_PARAMS with a prompt-scaled max_tokens"""
+    params = ANALYSIS_SAMPLING_PARAMS.clone()
+    params.max_tokens = adaptive_max_tokens(
+        n_prompt_tokens, cap=ANALYSIS_SAMPLING_PARAMS.max_tokens
     )
+    params.stop_token_ids = stop_token_ids
+    return params
 
-    # LLM inference
-    print("🧠 Analyzing with vLLM (Final Pass)...")
-    outputs = llm.generate([prompt], sampling_params)
-    summary = outputs[0].outputs[0].text.strip()
-    
-    inference_time_ms = int((time_module.time() - start_time) * 1000)
-    
-    print(f"✅ Analysis completed in {inference_time_ms}ms (Total)")
-    print(f"📊 Summary length: {len(summary)} characters")
-    print("\n" + "=" * 60)
-    print("GENERATED SUMMARY:")
-    print("-" * 60)
-    print(summary)
-    print("=" * 60 + "\n")
-    
-    return summary, inference_time_ms
 
+def analyze_batch(jobs, llm, on_partial=None):
+    """
+    Phase 2 (final pass): Run the final analysis for a micro-batch of requests
+    together in the vLLM engine. The engine is stepped directly (instead of
+    llm.generate) so partial text can be streamed while decoding.
 
-def process_ai():
-    consumer = KafkaConsumerWrapper(
-        topic=settings.KAFKA_TOPIC_AI, group_id=settings.KAFKA_GROUP_AI
+    Args:
+        jobs: List of dicts with "request_id", "prompt_token_ids" and "start_time"
+        llm: vLLM instance
+        on_partial: Optional callback(request_id, text), called at most every
+            AI_STREAM_INTERVAL_S with each unfinished request's text so far
+
+    Returns:
+        List of (summary_text, inference_time_ms), in the same order as jobs
+    """
+    logger.info("🧠 Analyzing %d request(s) with vLLM (Final Pass)...", len(jobs))
+    # Stop on the Llama 3 end-of-turn token explicitly
+    stop_token_ids = [llm.get_tokenizer().convert_tokens_to_ids("<|eot_id|>")]
+
+    engine = llm.llm_engine
+    engine_ids = [f"final-{job['request_id']}" for job in jobs]
+    texts = {engine_id: "" for engine_id in engine_ids}
+    finished = {}
+    stream = on_partial is not None and settings.AI_STREAM_INTERVAL_S > 0
+    last_emit = time.perf_counter()
+    try:
+        # Inside the try: if one add_request is rejected (e.g. prompt over
+        # max_model_len), the ones already added are aborted too
+        for engine_id, job in zip(engine_ids, jobs):
+            engine.add_request(
+                engine_id,
+                {"prompt_token_ids": job["prompt_token_ids"]},
+                analysis_sampling_params(len(job["prompt_token_ids"]), stop_token_ids),
+            )
+
+        while engine.has_unfinished_requests():
+            for output in engine.step():
+                texts[output.request_id] = output.outputs[0].text
+                if output.finished:
+                    finished[output.request_id] = time.perf_counter()
+
+            now = time.perf_counter()
+            if stream and now - last_emit >= settings.AI_STREAM_INTERVAL_S:
+                for engine_id, job in zip(engine_ids, jobs):
+                    if texts[engine_id] and engine_id not in finished:
+                        on_partial(job["request_id"], texts[engine_id])
+                last_emit = now
+    except Exception:
+        # Don't leave this batch's sequences running in the shared engine
+        engine.abort_request(engine_ids)
+        raise
+
+    results = []
+    for engine_id, job in zip(engine_ids, jobs):
+        summary = texts[engine_id].strip()
+        inference_time_ms = int((finished[engine_id] - job["start_time"]) * 1000)
+
+        logger.info(
+            "✅ Analysis done rid=%s ms=%d chars=%d",
+            job["request_id"], inference_time_ms, len(summary),
+        )
+        logger.debug("GENERATED SUMMARY (%s):\n%s", job["request_id"], summary)
+
+        results.append((summary, inference_time_ms))
+
+    return results
+
+
+# 🔒 Pessimistic Lock + claim in one round-trip:
+# lock the row (skipping rows locked by other workers) and flip its status
+CLAIM_QUERY = text("""
+    UPDATE requests
+    SET status = 'processing_analysis'
+    WHERE id = (
+        SELECT id
+        FROM requests
+        WHERE id = :request_id
+        AND status = 'analyzing'
+        FOR UPDATE SKIP LOCKED
     )
+    RETURNING id, topic
+""")
+
+COMPLETE_QUERY = text("""
+    UPDATE requests
+    SET status = 'completed', completed_at = NOW(), partial_summary = NULL
+    WHERE id = :request_id
+""")
+
+# Only while analyzing, so a late partial never overwrites a finished request
+PARTIAL_QUERY = text("""
+    UPDATE requests
+    SET partial_summary = :text
+    WHERE id = :request_id
+    AND status = 'processing_analysis'
+""")
+
+FAIL_QUERY = text("""
+    UPDATE requests
+    SET status = 'failed', error_message = :error, partial_summary = NULL
+    WHERE id = :request_id
+""")
+
+
+def mark_failed(db, request_id, error):
+    """Update request to failed status (best effort)"""
+    try:
+        db.rollback()
+        with db.begin():
+            db.execute(FAIL_QUERY, {"request_id": request_id, "error": str(error)})
+    except:
+        pass
+
+
+def save_partial(db, request_id, partial_text):
+    """Store the summary generated so far (best effort, runs on the progress thread)"""
+    try:
+        with db.begin():
+            db.execute(PARTIAL_QUERY, {"request_id": request_id, "text": partial_text})
+    except Exception as e:
+        logger.warning("⚠️  Failed to save partial summary rid=%s: %s", request_id, e)
+
+
+def claim_request(message, db):
+    """
+    Claim a request with a pessimistic lock and load its search results.
+    Only does Kafka/DB work so it can overlap with GPU inference of the
+    previous batch.
+
+    Returns:
+        dict job for run_inference, or None if the message should be skipped
+    """
+    task = message.value
+    request_id = task.get("request_id")
+    topic = task.get("topic")
+    phase = task.get("phase", "analyze")  # Default to analysis phase
+
+    logger.info("📨 Request rid=%s phase=%s topic=%s", request_id, phase, topic)
+
+    if phase == "generate_queries":
+        # Phase 1: Generate search queries (future implementation)
+        logger.warning("⚠️  Query generation phase not yet implemented, falling back to analysis")
+        phase = "analyze"
+
+    if phase != "analyze":
+        return None
+
+    try:
+        start_time = time.perf_counter()
+
+        # One transaction per claim (commits on exit, rolls back on error)
+        with db.begin():
+            claimed = db.execute(CLAIM_QUERY, {"request_id": request_id}).fetchone()
+
+            if not claimed:
+                # Diagnostics only (skip path)
+                existing = db.get(Request, request_id)
+                if existing:
+                    if existing.status == 'analyzing':
+                        logger.info("🔒 Request %s locked by another worker, skipping", request_id)
+                    else:
+                        logger.info("⏭️  Request %s already processed (status: %s)", request_id, existing.status)
+                else:
+                    logger.warning("❌ Request %s not found", request_id)
+                return None
+
+            search_results = load_search_results(request_id, db)
+
+        logger.info("✅ Locked and claimed request %s", request_id)
 
-    print(f"🤖 [AI Worker] Ready for inference...")
+        return {
+            "request_id": request_id,
+            "topic": claimed.topic,
+            "search_results": search_results,
+            "start_time": start_time,
+        }
 
-    for message in consumer.get_messages():
-        db = SessionLocal()
+    except Exception as e:
+        logger.exception("AI Worker Error: %s", e)
+        mark_failed(db, request_id, e)
+        return None
+
+
+def run_inference(jobs, llm, on_partial=None):
+    """
+    Build prompts (Map phase if needed) and run the batched final pass.
+    Runs on the dedicated inference thread; stores "summary" and
+    "inference_time_ms" (or "error") on each job. on_partial is forwarded
+    to analyze_batch() for streaming.
+    """
+    tokenizer = llm.get_tokenizer()
+    max_model_len = llm.llm_engine.model_config.max_model_len
+
+    # Plan every request first so all Map prompts of the batch share one generate
+    planned = []
+    map_prompts = []
+    for job in jobs:
         try:
-            task = message.value
-            request_id = task.get("request_id")
-            topic = task.get("topic")
-            phase = task.get("phase", "analyze")  # Default to analysis phase
-
-            print("\n" + "=" * 60)
-            print(f"Request ID: {request_id}")
-            print(f"Topic: {topic}")
-            print(f"Phase: {phase}")
-
-            if phase == "generate_queries":
-                # Phase 1: Generate search queries (future implementation)
-                print("⚠️  Query generation phase not yet implemented")
-                print("⚠️  Falling back to analysis phase")
-                phase = "analyze"
-            
-            if phase == "analyze":
-                # Phase 2: Analyze search results
-                
-                # 🔒 Pessimistic Lock: Row-level locking
-                lock_query = text("""
-                    SELECT id, status 
-                    FROM requests 
-                    WHERE id = :request_id 
-                    AND status = 'analyzing'
-                    FOR UPDATE SKIP LOCKED
-                """)
-                
-                result = db.execute(lock_query, {"request_id": request_id}).fetchone()
-                
-                if not result:
-                    existing = db.query(Request).filter(Request.id == request_id).first()
-                    if existing:
-                        if existing.status == 'analyzing':
-                            print(f"🔒 Request {request_id} locked by another worker, skipping")
-                        else:
-                            print(f"⏭️  Request {request_id} already processed (status: {existing.status})")
-                    else:
-                        print(f"❌ Request {request_id} not found")
-                    consumer.consumer.commit()
-                    continue
-
-                # Claim the request
-                db_request = db.query(Request).filter(Request.id == request_id).first()
-                db_request.status = 'processing_analysis'
-                db.commit()
-                print(f"✅ Locked and claimed request {request_id}")
-
-                # Analyze search results
-                summary, inference_time_ms = analyze_search_results(
-                    request_id, topic, db, llm
-                )
+            context_parts, job_map_prompts = plan_analysis_context(
+                job["topic"], job["search_results"], tokenizer, max_model_len
+            )
+            job["context_parts"] = context_parts
+            job["context_separator"] = CONTEXT_SEPARATOR
+            if job_map_prompts:
+                job["map_slice"] = slice(len(map_prompts), len(map_prompts) + len(job_map_prompts))
+                map_prompts.extend(job_map_prompts)
+            planned.append(job)
+        except Exception as e:
+            logger.exception("AI Worker Error: %s", e)
+            job["error"] = e
+
+    if map_prompts:
+        logger.info("🚀 Running batch inference for %d chunks...", len(map_prompts))
+        # Submit longest first so similar-length prompts are scheduled together,
+        # then restore the original order for the per-request slices
+        order = sorted(
+            range(len(map_prompts)),
+            key=lambda i: len(map_prompts[i]["prompt_token_ids"]),
+            reverse=True,
+        )
+        try:
+            sorted_outputs = llm.generate(
+                [map_prompts[i] for i in order],
+                [map_sampling_params(len(map_prompts[i]["prompt_token_ids"])) for i in order],
+            )
+            map_outputs = [None] * len(map_prompts)
+            for output, i in zip(sorted_outputs, order):
+                map_outputs[i] = output
+        except Exception as e:
+            logger.exception("AI Worker Error: %s", e)
+            map_outputs = None
+
+        # [Reduce Phase] Combine each request's summaries
+        for job in planned:
+            if "map_slice" not in job:
+                continue
+            if map_outputs is None:
+                job["error"] = RuntimeError("Map phase generation failed")
+                continue
+            intermediate_summaries = [
+                output.outputs[0].text.strip() for output in map_outputs[job["map_slice"]]
+            ]
+            job["context_parts"] = [
+                f"Summary Part {i+1}:\n{s}" for i, s in enumerate(intermediate_summaries)
+            ]
+            job["context_separator"] = "\n\n---\n\n"
+            logger.info(
+                "📉 Reduced context rid=%s: %d chars",
+                job["request_id"], sum(len(part) for part in job["context_parts"]),
+            )
+
+    ready = []
+    for job in planned:
+        if "error" in job:
+            continue
+        try:
+            job["prompt_token_ids"] = build_final_prompt_ids(
+                job["topic"], job["context_parts"], job["context_separator"],
+                tokenizer, max_model_len,
+            )
+            ready.append(job)
+        except Exception as e:
+            logger.exception("AI Worker Error: %s", e)
+            job["error"] = e
+
+    if not ready:
+        return jobs
+
+    try:
+        results = analyze_batch(ready, llm, on_partial)
+        for job, (summary, inference_time_ms) in zip(ready, results):
+            job["summary"] = summary
+            job["inference_time_ms"] = inference_time_ms
+    except Exception as e:
+        logger.exception("AI Worker Error: %s", e)
+        for job in ready:
+            job["error"] = e
+
+    return jobs
+
 
+def persist_batch(batch, db):
+    """
+    Wait for a batch's inference and save its results.
+    Runs on the single writer thread (with its own session) so persistence
+    overlaps with GPU inference of the next batch.
+    """
+    if batch.get("future"):
+        batch["future"].result()
+
+    # Save each result independently (partial-batch failures)
+    for job in batch["jobs"]:
+        request_id = job["request_id"]
+        if "error" in job:
+            mark_failed(db, request_id, job["error"])
+            continue
+        try:
+            with db.begin():
                 # Save analysis result
                 analysis_result = AnalysisResult(
                     request_id=request_id,
-                    summary=summary,
-                    inference_time_ms=inference_time_ms
+                    summary=job["summary"],
+                    inference_time_ms=job["inference_time_ms"]
                 )
                 db.add(analysis_result)
 
                 # Update request status
-                db_request.status = "completed"
-                db_request.completed_at = datetime.utcnow()
-                db.commit()
+                db.execute(COMPLETE_QUERY, {"request_id": request_id})
+            logger.info("Request %s completed!", request_id)
+        except Exception as e:
+            logger.exception("AI Worker Error: %s", e)
+            mark_failed(db, request_id, e)
 
-                # Commit Kafka offset
-                consumer.consumer.commit()
-                print(f"Kafka offset committed")
-                print(f"Request {request_id} completed!")
 
+def commit_persisted(in_flight, consumer, block=False):
+    """
+    Commit Kafka offsets of persisted batches, oldest first.
+    Stops at the first batch still being saved so offsets never get ahead of
+    the database. With block=True, waits for the oldest batch first.
+    """
+    if block and in_flight:
+        wait([in_flight[0]["saved"]])
+
+    while in_flight and in_flight[0]["saved"].done():
+        batch = in_flight.popleft()
+        try:
+            batch["saved"].result()
+            # Commit only this batch's offsets (later batches are already fetched)
+            consumer.commit_offsets(batch["messages"], asynchronous=True)
+            logger.info("Kafka offset committed")
         except Exception as e:
-            print(f"AI Worker Error: {e}")
-            import traceback
-            traceback.print_exc()
-            
-            # Update to failed status
-            if 'request_id' in locals() and request_id:
-                try:
-                    db_request = db.query(Request).filter(Request.id == request_id).first()
-                    if db_request:
-                        db_request.status = "failed"
-                        db_request.error_message = str(e)
-                        db.commit()
-                except:
-                    pass
-        finally:
-            db.close()
+            logger.exception("AI Worker Error: %s", e)
+
+
+# Batches allowed between claim and offset commit: one on the GPU, one queued
+MAX_IN_FLIGHT = 2
+
+
+def process_ai():
+    # Load the model before joining the consumer group
+    llm = get_llm()
+
+    consumer = KafkaConsumerWrapper(
+        topic=settings.KAFKA_TOPIC_AI, group_id=settings.KAFKA_GROUP_AI
+    )
+
+    # Single inference thread: the GPU works on one batch while the main
+    # thread fetches and claims the next one from Kafka/PostgreSQL
+    inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+    # Single writer thread: saves finished batches in order, off the main loop
+    persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+    # Progress thread: streams partial summaries to the DB without blocking
+    # the inference thread (the writer is busy waiting on the current batch)
+    progress_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="progress")
+    in_flight = deque()
+
+    # One session per thread for the worker lifetime; each claim/save is its
+    # own transaction (persist_db / progress_db are only used on their threads)
+    db = SessionLocal()
+    persist_db = SessionLocal()
+    progress_db = SessionLocal()
+
+    def on_partial(request_id, partial_text):
+        progress_executor.submit(save_partial, progress_db, request_id, partial_text)
+
+    logger.info("🤖 [AI Worker] Ready for inference (batch size: %d)...", settings.AI_BATCH_SIZE)
+
+    try:
+        for messages in consumer.get_batches(
+            max_records=settings.AI_BATCH_SIZE, timeout_ms=settings.AI_POLL_TIMEOUT_MS
+        ):
+            if not messages:
+                # Idle poll: commit whatever has been saved meanwhile
+                commit_persisted(in_flight, consumer)
+                continue
+
+            logger.info("📥 Received batch of %d message(s)", len(messages))
+
+            # Claim requests and load search results (overlaps with GPU work)
+            jobs = [job for job in (claim_request(message, db) for message in messages) if job]
+            batch = {"messages": messages, "jobs": jobs}
+
+            if jobs:
+                batch["future"] = inference_executor.submit(run_inference, jobs, llm, on_partial)
+            batch["saved"] = persist_executor.submit(persist_batch, batch, persist_db)
+            in_flight.append(batch)
+
+            commit_persisted(in_flight, consumer)
+            # Backpressure: don't claim further ahead than the GPU can use
+            while len(in_flight) > MAX_IN_FLIGHT:
+                commit_persisted(in_flight, consumer, block=True)
+
+        while in_flight:
+            commit_persisted(in_flight, consumer, block=True)
+    finally:
+        inference_executor.shutdown()
+        persist_executor.shutdown()
+        progress_executor.shutdown()
+        db.close()
+        persist_db.close()
+        progress_db.close()
 
 
 if __name__ == "__main__":
@@ -1,15 +1,192 @@
-from fastapi import FastAPI, Depends, HTTPException, Query
+import asyncio
+import base64
+import threading
+import time
+from contextlib import asynccontextmanager
+import asyncpg
+import orjson
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer, joinedload
+from sqlalchemy import func, desc, insert, make_url, select, text, tuple_, update
 from uuid import UUID
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Optional
-from common.utils import KafkaProducerWrapper
-from common.database import get_db, Request, SearchResult, AnalysisResult
+from common.config import settings
+from common.utils import KafkaProducerWrapper, message_key, setup_logging
+from common.database import (
+    get_db, get_async_sessionmaker, migrate_schema, Request, SearchResult, AnalysisResult
+)
+
+logger = setup_logging("api_server")
+
+# Created on first use (only /analyze publishes), so the API starts and
+# serves reads while Kafka is still coming up
+producer: Optional[KafkaProducerWrapper] = None
+_producer_lock = threading.Lock()
+# A failed connect is short and bounded, and for PRODUCER_RETRY_COOLDOWN_S
+# after it get_producer fails fast instead of every queued /analyze task
+# retrying in turn behind the lock
+PRODUCER_CONNECT_RETRIES = 2
+PRODUCER_RETRY_COOLDOWN_S = 10.0
+_producer_failed_at: Optional[float] = None
+
+
+class ProducerUnavailable(RuntimeError):
+    """Kafka couldn't be reached; the caller fails the request"""
+
+
+def get_producer():
+    """Return the shared Kafka producer, connecting on the first call"""
+    global producer, _producer_failed_at
+    if producer is None:
+        with _producer_lock:
+            if producer is None:
+                if (_producer_failed_at is not None
+                        and time.monotonic() - _producer_failed_at < PRODUCER_RETRY_COOLDOWN_S):
+                    raise ProducerUnavailable("Kafka unavailable (retrying shortly)")
+                try:
+                    producer = KafkaProducerWrapper(
+                        max_retries=PRODUCER_CONNECT_RETRIES, initial_delay=1,
+                        exit_on_failure=False,
+                    )
+                except Exception as e:
+                    _producer_failed_at = time.monotonic()
+                    raise ProducerUnavailable(f"Kafka unavailable: {e}") from e
+                _producer_failed_at = None
+    return producer
+
+
+PUBLISH_TIMEOUT_S = 30
+
+
+def send_search_task(request_id, topic):
+    """Publish a search task and wait for the broker ack (blocking)"""
+    future = get_producer().send_data(
+        topic="search-queue",
+        value={"request_id": request_id, "topic": topic},
+        key=message_key(topic),
+    )
+    future.get(timeout=PUBLISH_TIMEOUT_S)
+
+
+async def publish_search_task(request_id, topic):
+    """
+    Background task: hand a new request to the search worker.
+    If the task never reaches Kafka the row is marked failed, like the
+    workers do, instead of staying 'searching' forever.
+    """
+    try:
+        # Connecting and send() can block, so they run in the threadpool
+        await run_in_threadpool(send_search_task, request_id, topic)
+        return
+    except ProducerUnavailable as e:
+        error = str(e)
+    except Exception as e:
+        error = f"Failed to publish search task: {e}"
+
+    logger.error("❌ %s (request %s)", error, request_id)
+    async with get_async_sessionmaker()() as db:
+        await db.execute(
+            update(Request)
+            .where(Request.id == UUID(request_id))
+            .values(status="failed", error_message=error)
+        )
+        await db.commit()
+
+
+class RequestUpdates:
+    """
+    One LISTEN connection per process for the request_updates channel
+    (see notify_request_update in init.sql). Streams wait on an asyncio.Event
+    per request id instead of polling the DB while nothing changes.
+    """
+
+    CHANNEL = "request_updates"
+
+    def __init__(self):
+        self._connection = None
+        self._connect_lock = asyncio.Lock()
+        self._waiters = {}  # request id (str) -> set of asyncio.Event
 
-app = FastAPI(title="AI Agent API", version="1.0.0")
+    @property
+    def connected(self):
+        return self._connection is not None and not self._connection.is_closed()
+
+    async def start(self):
+        """Open the LISTEN connection if needed; streams fall back to polling on failure"""
+        if self.connected:
+            return
+        async with self._connect_lock:
+            if self.connected:
+                return
+            dsn = make_url(settings.DATABASE_URL).set(drivername="postgresql")
+            try:
+                connection = await asyncpg.connect(dsn.render_as_string(hide_password=False))
+                await connection.add_listener(self.CHANNEL, self._on_notify)
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning("⚠️  LISTEN %s unavailable, polling instead: %s", self.CHANNEL, e)
+                return
+            connection.add_termination_listener(self._on_terminate)
+            self._connection = connection
+            logger.info("👂 Listening on %s", self.CHANNEL)
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def subscribe(self, request_id):
+        event = asyncio.Event()
+        self._waiters.setdefault(str(request_id), set()).add(event)
+        return event
+
+    def unsubscribe(self, request_id, event):
+        waiters = self._waiters.get(str(request_id))
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[str(request_id)]
+
+    def _on_notify(self, connection, pid, channel, payload):
+        for event in self._waiters.get(payload, ()):
+            event.set()
+
+    def _on_terminate(self, connection):
+        logger.warning("⚠️  LISTEN connection lost; streams poll until it reconnects")
+        self._connection = None
+        # Wake every stream so it re-reads instead of waiting out the timeout
+        for waiters in self._waiters.values():
+            for event in waiters:
+                event.set()
+
+
+request_updates = RequestUpdates()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Upgrade databases created by an older init.sql before serving
+    await migrate_schema(get_async_sessionmaker().kw["bind"])
+    yield
+    await request_updates.close()
+    # Flush buffered (lingering) messages before the process exits
+    if producer is not None:
+        producer.close()
+
+
+# orjson encodes datetime/UUID natively and is much faster than stdlib json
+# on the large detail/list payloads
+app = FastAPI(
+    title="AI Agent API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 # CORS settings (for React dev server)
 app.add_middleware(
@@ -20,8 +197,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-producer = KafkaProducerWrapper()
-
 
 # Request Schema
 class AnalyzeRequest(BaseModel):
@@ -29,33 +204,34 @@ class AnalyzeRequest(BaseModel):
 
 
 @app.post("/analyze")
-def analyze(req: AnalyzeRequest, db: Session = Depends(get_db)):
+async def analyze(
+    req: AnalyzeRequest,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
+):
     """
     Create analysis request and start pipeline
-    1. Save request to DB (pending status)
+    1. Save request to DB (already in searching status)
     2. Publish search task to Kafka
-    3. Update status to searching
     """
-    # 1. Create request in DB
-    db_request = Request(topic=req.topic, status="pending")
-    db.add(db_request)
-    db.commit()
-    db.refresh(db_request)
-    
-    request_id = str(db_request.id)
-    print(f"📝 Created request {request_id} for topic: {req.topic}")
-    
-    # 2. Publish search task to Kafka (with request_id)
-    producer.send_data(
-        topic="search-queue",
-        value={"request_id": request_id, "topic": req.topic}
+    # 1. Create request in DB: one INSERT ... RETURNING, committed before the
+    # task is published so the search worker always finds the row
+    request_id = str(
+        (
+            await db.execute(
+                insert(Request)
+                .values(topic=req.topic, status="searching")
+                .returning(Request.id)
+            )
+        ).scalar_one()
     )
-    
-    # 3. Update status
-    db_request.status = "searching"
-    db.commit()
-    print(f"🔍 Status updated to 'searching' for request {request_id}")
-    
+    await db.commit()
+    logger.info("📝 Created request %s for topic: %s", request_id, req.topic)
+
+    # 2. Publish search task to Kafka (with request_id) after the response is
+    # sent; the blocking connect/send runs in the threadpool
+    background_tasks.add_task(publish_search_task, request_id, req.topic)
+
     return {
         "request_id": request_id,
         "status": "searching",
@@ -64,160 +240,368 @@ def analyze(req: AnalyzeRequest, db: Session = Depends(get_db)):
 
 
 @app.get("/status/{request_id}")
-def get_status(request_id: UUID, db: Session = Depends(get_db)):
+async def get_status(request_id: UUID, db: AsyncSession = Depends(get_db)):
     """
     Get request status
     - Check pipeline progress by request_id
     - Includes search results count and analysis completion status
     """
-    db_request = db.query(Request).filter(Request.id == request_id).first()
-    
+    db_request = (
+        await db.execute(
+            select(Request)
+            .options(
+                defer(Request.partial_summary, raiseload=True),
+                joinedload(Request.analysis_result),
+            )
+            .where(Request.id == request_id)
+        )
+    ).scalar_one_or_none()
+
     if not db_request:
         raise HTTPException(status_code=404, detail="Request not found")
-    
+
     # Basic info
     result = {
         "request_id": str(db_request.id),
         "topic": db_request.topic,
         "status": db_request.status,
-        "created_at": db_request.created_at.isoformat(),
-        "updated_at": db_request.updated_at.isoformat(),
+        "created_at": db_request.created_at,
+        "updated_at": db_request.updated_at,
     }
-    
+
     # Completion time (if exists)
     if db_request.completed_at:
-        result["completed_at"] = db_request.completed_at.isoformat()
-    
+        result["completed_at"] = db_request.completed_at
+
     # Error message (if exists)
     if db_request.error_message:
         result["error"] = db_request.error_message
-    
-    # Search results count
-    result["search_results_count"] = len(db_request.search_results)
-    
+
+    # Search results count (denormalized column, no COUNT query)
+    result["search_results_count"] = db_request.search_results_count
+
     # Analysis result (if completed)
     if db_request.analysis_result:
         result["summary"] = db_request.analysis_result.summary
         result["inference_time_ms"] = db_request.analysis_result.inference_time_ms
-    
+
     return result
 
 
+def sse_event(event, payload):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {orjson.dumps(payload).decode()}\n\n"
+
+
+@app.get("/stream/{request_id}")
+async def stream_request(request_id: UUID):
+    """
+    Stream request progress as Server-Sent Events
+    - "partial": status and the summary generated so far (while analyzing)
+    - "done": final summary, then the stream closes
+    - "error": request failed or not found
+    """
+    async def events():
+        await request_updates.start()
+        # Subscribe before the first read so no NOTIFY is missed in between
+        updated = request_updates.subscribe(request_id)
+        try:
+            async for event in poll_events(updated):
+                yield event
+        finally:
+            request_updates.unsubscribe(request_id, updated)
+
+    async def poll_events(updated):
+        # Own session: the response outlives request-scoped dependencies
+        async with get_async_sessionmaker()() as db:
+            last = None
+            while True:
+                updated.clear()
+                row = (
+                    await db.execute(
+                        select(Request.status, Request.partial_summary, Request.error_message)
+                        .where(Request.id == request_id)
+                    )
+                ).first()
+                if row is None:
+                    yield sse_event("error", {"error": "Request not found"})
+                    return
+
+                if row.status == "completed":
+                    analysis = (
+                        await db.execute(
+                            select(AnalysisResult.summary, AnalysisResult.inference_time_ms)
+                            .where(AnalysisResult.request_id == request_id)
+                        )
+                    ).first()
+                    yield sse_event("done", {
+                        "status": row.status,
+                        "summary": analysis.summary if analysis else None,
+                        "inference_time_ms": analysis.inference_time_ms if analysis else None,
+                    })
+                    return
+
+                if row.status == "failed":
+                    yield sse_event("error", {"status": row.status, "error": row.error_message})
+                    return
+
+                # Only send when something changed
+                if (row.status, row.partial_summary) != last:
+                    last = (row.status, row.partial_summary)
+                    yield sse_event("partial", {
+                        "status": row.status,
+                        "partial_summary": row.partial_summary,
+                    })
+
+                # End the read transaction so the next read sees new commits
+                await db.rollback()
+                await wait_for_update(updated)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def wait_for_update(updated):
+    """Wait for a NOTIFY for this request, or poll when LISTEN is unavailable"""
+    if not request_updates.connected:
+        await asyncio.sleep(settings.STREAM_POLL_INTERVAL_S)
+        return
+    try:
+        # The timeout is only a safety net for lost notifications
+        await asyncio.wait_for(updated.wait(), settings.STREAM_NOTIFY_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        pass
+
+
 # ============ Dashboard API ============
 
+def encode_cursor(created_at, request_id):
+    """Opaque keyset cursor for the (created_at, id) position of a row"""
+    raw = f"{created_at.isoformat()}|{request_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); raises HTTP 400 for malformed cursors"""
+    try:
+        created_at, request_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), UUID(request_id)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+
 @app.get("/api/requests")
-def list_requests(
+async def list_requests(
     status: Optional[str] = None,
-    limit: int = Query(20, le=100),
-    offset: int = 0,
-    db: Session = Depends(get_db)
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    db: AsyncSession = Depends(get_db)
 ):
-    """List requests (with pagination)"""
-    query = db.query(Request)
-    
+    """
+    List requests (with pagination)
+    - cursor: next_cursor of the previous page (keyset pagination; reads only
+      `limit` rows at any depth, unlike offset)
+    - include_total: set false on follow-up pages to skip the COUNT(*)
+    """
+    filters = []
     if status and status != 'all':
-        query = query.filter(Request.status == status)
-    
-    total = query.count()
-    
-    requests = query.order_by(desc(Request.created_at))\
-                    .limit(limit)\
-                    .offset(offset)\
-                    .all()
-    
-    return {
+        filters.append(Request.status == status)
+
+    total = (
+        await db.scalar(select(func.count(Request.id)).where(*filters))
+        if include_total else None
+    )
+
+    if cursor:
+        filters.append(tuple_(Request.created_at, Request.id) < tuple_(*decode_cursor(cursor)))
+
+    # search_results_count is a column on requests: no join or subquery.
+    # partial_summary can be long and isn't listed, so it's not fetched
+    requests = (
+        await db.execute(
+            select(Request)
+            .options(defer(Request.partial_summary, raiseload=True))
+            .where(*filters)
+            .order_by(desc(Request.created_at), desc(Request.id))
+            .limit(limit)
+            .offset(offset)
+        )
+    ).scalars().all()
+
+    # Returning the response directly skips FastAPI's jsonable_encoder pass;
+    # orjson encodes the datetimes itself
+    return ORJSONResponse({
         "total": total,
+        "next_cursor": (
+            encode_cursor(requests[-1].created_at, requests[-1].id)
+            if requests and len(requests) == limit else None
+        ),
         "items": [
             {
                 "request_id": str(r.id),
                 "topic": r.topic,
                 "status": r.status,
-                "created_at": r.created_at.isoformat(),
-                "completed_at": r.completed_at.isoformat() if r.completed_at else None,
+                "created_at": r.created_at,
+                "completed_at": r.completed_at,
                 "error_message": r.error_message,
-                "search_results_count": len(r.search_results)
+                "search_results_count": r.search_results_count
             }
             for r in requests
         ]
-    }
+    })
 
 
 @app.get("/api/requests/{request_id}")
-def get_request_detail(
+async def get_request_detail(
     request_id: UUID,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get request details (including search results + AI analysis)"""
-    request = db.query(Request).filter(Request.id == request_id).first()
+    # Load the request with its analysis, then the search results as plain
+    # rows (columns only, already keyed for the response)
+    request = (
+        await db.execute(
+            select(Request)
+            .options(
+                defer(Request.partial_summary, raiseload=True),
+                joinedload(Request.analysis_result),
+            )
+            .where(Request.id == request_id)
+        )
+    ).scalar_one_or_none()
     if not request:
         raise HTTPException(404, "Request not found")
-    
-    return {
+
+    search_results = (
+        await db.execute(
+            select(
+                SearchResult.id,
+                SearchResult.url,
+                SearchResult.title,
+                SearchResult.content,
+                SearchResult.created_at,
+            )
+            .where(SearchResult.request_id == request_id)
+            .order_by(SearchResult.id)
+        )
+    ).mappings().all()
+
+    # Large payload (page contents): skip the jsonable_encoder walk, orjson
+    # serializes the rows in one pass
+    return ORJSONResponse({
         "request": {
             "request_id": str(request.id),
             "topic": request.topic,
             "status": request.status,
-            "created_at": request.created_at.isoformat(),
-            "updated_at": request.updated_at.isoformat(),
-            "completed_at": request.completed_at.isoformat() if request.completed_at else None,
+            "created_at": request.created_at,
+            "updated_at": request.updated_at,
+            "completed_at": request.completed_at,
             "error_message": request.error_message
         },
-        "search_results": [
-            {
-                "id": sr.id,
-                "url": sr.url,
-                "title": sr.title,
-                "content": sr.content,
-                "created_at": sr.created_at.isoformat()
-            }
-            for sr in request.search_results
-        ],
+        "search_results": [dict(sr) for sr in search_results],
         "analysis_result": {
             "summary": request.analysis_result.summary,
             "inference_time_ms": request.analysis_result.inference_time_ms,
-            "created_at": request.analysis_result.created_at.isoformat()
+            "created_at": request.analysis_result.created_at
         } if request.analysis_result else None
-    }
+    })
+
+
+# Dense hourly histogram: each generated hour counts its rows with a
+# created_at range probe (idx_requests_created_at), so empty hours are
+# returned as 0 and no per-row date_trunc hashing is needed. The hours come
+# from the DB clock (now()::timestamp, the same conversion as the
+# created_at defaults), not the API host's
+HOURLY_QUERY = text("""
+    SELECT g.hour, COUNT(r.id) AS count
+    FROM generate_series(
+        date_trunc('hour', now()::timestamp) - interval '23 hours',
+        date_trunc('hour', now()::timestamp),
+        interval '1 hour'
+    ) AS g(hour)
+    LEFT JOIN requests r
+        ON r.created_at >= g.hour AND r.created_at < g.hour + interval '1 hour'
+    GROUP BY g.hour
+    ORDER BY g.hour
+""")
+
+# Dashboards poll /api/metrics. Per API process, one computation is shared
+# by all polls: fresh for METRICS_CACHE_TTL_S, then served stale for up to
+# METRICS_STALE_S more while a single background task recomputes it.
+METRICS_STALE_S = 30
+_metrics: Optional[tuple] = None  # (monotonic computed_at, metrics)
+_metrics_lock = asyncio.Lock()
+_metrics_refresh: Optional[asyncio.Task] = None
+
+
+async def refresh_metrics(db):
+    """Recompute the metrics and store them with their timestamp"""
+    global _metrics
+    metrics = await compute_metrics(db)
+    _metrics = (time.monotonic(), metrics)
+    return metrics
+
+
+async def refresh_metrics_in_background():
+    """Background refresh with its own session (the request's is closed by then)"""
+    try:
+        async with _metrics_lock:
+            async with get_async_sessionmaker()() as db:
+                await refresh_metrics(db)
+    except Exception as e:
+        logger.warning("⚠️ Metrics refresh failed: %s", e)
 
 
 @app.get("/api/metrics")
-def get_metrics(db: Session = Depends(get_db)):
-    """Get system metrics"""
-    # Total requests count
-    total = db.query(func.count(Request.id)).scalar()
-    
-    # Completed requests count
-    completed = db.query(func.count(Request.id))\
-                  .filter(Request.status == 'completed')\
-                  .scalar()
-    
-    # Average inference time
-    avg_time = db.query(func.avg(AnalysisResult.inference_time_ms))\
-                 .scalar() or 0
-    
-    # Status distribution
-    status_dist = db.query(
-        Request.status,
-        func.count(Request.id)
-    ).group_by(Request.status).all()
-    
-    # Requests by hour (last 24 hours)
-    since = datetime.utcnow() - timedelta(hours=24)
-    hourly = db.query(
-        func.date_trunc('hour', Request.created_at).label('hour'),
-        func.count(Request.id).label('count')
-    ).filter(Request.created_at >= since)\
-     .group_by('hour')\
-     .order_by('hour')\
-     .all()
-    
+async def get_metrics(response: Response, db: AsyncSession = Depends(get_db)):
+    """Get system metrics (cached for METRICS_CACHE_TTL_S, then stale-while-revalidate)"""
+    global _metrics_refresh
+    response.headers["Cache-Control"] = (
+        f"max-age={int(settings.METRICS_CACHE_TTL_S)}, stale-while-revalidate={METRICS_STALE_S}"
+    )
+    cached = _metrics
+    age = time.monotonic() - cached[0] if cached else None
+    if age is None or age > settings.METRICS_CACHE_TTL_S + METRICS_STALE_S:
+        # Nothing usable: only one request computes, the others wait and reuse it
+        async with _metrics_lock:
+            if _metrics is cached:
+                return await refresh_metrics(db)
+            return _metrics[1]
+    if age > settings.METRICS_CACHE_TTL_S and (_metrics_refresh is None or _metrics_refresh.done()):
+        _metrics_refresh = asyncio.create_task(refresh_metrics_in_background())
+    return cached[1]
+
+
+async def compute_metrics(db):
+    """Run the metrics aggregates"""
+    # Status distribution (one scan; total and completed are derived from it).
+    # The average inference time rides along as an uncorrelated scalar
+    # subquery (evaluated once by Postgres), saving a round-trip
+    avg_inference_time = select(func.avg(AnalysisResult.inference_time_ms)).scalar_subquery()
+    rows = (
+        await db.execute(
+            select(Request.status, func.count(Request.id), avg_inference_time)
+            .group_by(Request.status)
+        )
+    ).all()
+    status_dist = {status: count for status, count, _ in rows}
+    total = sum(status_dist.values())
+    completed = status_dist.get('completed', 0)
+
+    # Average inference time (no rows means no requests, hence no analyses)
+    avg_time = (rows[0][2] if rows else None) or 0
+
+    # Requests by hour (last 24 hours, one row per hour even when empty)
+    hourly = (await db.execute(HOURLY_QUERY)).all()
+
     return {
         "total_requests": total,
         "success_rate": completed / total if total > 0 else 0,
         "avg_inference_time_ms": int(avg_time),
-        "requests_by_status": {s: c for s, c in status_dist},
+        "requests_by_status": status_dist,
         "requests_by_hour": [
-            {"hour": h.isoformat(), "count": c}
+            {"hour": h, "count": c}
             for h, c in hourly
         ]
     }
@@ -3,20 +3,44 @@ Utility functions extracted from ai-worker for testability.
 This module contains functions that don't require vLLM import.
 """
 import os
+import logging
+import math
+import re
+import subprocess
+from bisect import bisect_right
+from collections import Counter
+from functools import lru_cache
 
+logger = logging.getLogger(__name__)
 
+
+@lru_cache(maxsize=1)
 def get_gpu_memory_gb():
     """
-    Detect GPU VRAM in GB using nvidia-smi or pynvml.
+    Detect GPU VRAM in GB using pynvml or nvidia-smi (cached: it can't
+    change while the process runs).
     Returns None if no GPU is detected.
     """
+    # In-process NVML query first: no fork/exec of nvidia-smi
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        info = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        memory_gb = info.total / (1024 ** 3)
+        pynvml.nvmlShutdown()
+        return memory_gb
+    except Exception as e:
+        # Expected without pynvml (or NVML): nvidia-smi is the fallback
+        logger.debug("pynvml GPU memory query unavailable: %s", e)
+
+    # Fallback: nvidia-smi
     try:
-        import subprocess
         result = subprocess.run(
             ["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
             capture_output=True,
             text=True,
-            timeout=10
+            timeout=2
         )
         if result.returncode == 0:
             # Get first GPU's memory (in MB), convert to GB
@@ -24,44 +48,256 @@ def get_gpu_memory_gb():
             memory_gb = memory_mb / 1024
             return memory_gb
     except Exception as e:
-        print(f"⚠️  Failed to detect GPU memory via nvidia-smi: {e}")
+        logger.warning("⚠️  Failed to detect GPU memory via nvidia-smi: %s", e)
     
-    # Fallback: try pynvml
+    return None
+
+
+@lru_cache(maxsize=1)
+def get_gpu_compute_capability():
+    """
+    Detect GPU compute capability (e.g. 8.9 for RTX 40xx) using pynvml or
+    nvidia-smi (cached).
+    Returns None if no GPU is detected.
+    """
     try:
         import pynvml
         pynvml.nvmlInit()
         handle = pynvml.nvmlDeviceGetHandleByIndex(0)
-        info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-        memory_gb = info.total / (1024 ** 3)
+        major, minor = pynvml.nvmlDeviceGetCudaComputeCapability(handle)
         pynvml.nvmlShutdown()
-        return memory_gb
+        return float(f"{major}.{minor}")
     except Exception as e:
-        print(f"⚠️  Failed to detect GPU memory via pynvml: {e}")
-    
+        logger.debug("pynvml compute capability query unavailable: %s", e)
+
+    # Fallback: nvidia-smi
+    try:
+        result = subprocess.run(
+            ["nvidia-smi", "--query-gpu=compute_cap", "--format=csv,noheader"],
+            capture_output=True,
+            text=True,
+            timeout=2
+        )
+        if result.returncode == 0:
+            # Get first GPU's compute capability (e.g. "8.9")
+            return float(result.stdout.strip().split('\n')[0])
+    except Exception as e:
+        logger.warning("⚠️  Failed to detect compute capability via nvidia-smi: %s", e)
+
     return None
 
 
-def select_model_by_vram(vram_gb):
+def supports_fp8(compute_capability):
+    """FP8 W8A8 tensor cores are available from Ada Lovelace (8.9) / Hopper (9.0)"""
+    return compute_capability is not None and compute_capability >= 8.9
+
+
+# Model configurations by VRAM tier (English-focused Llama models), sorted by
+# ascending min_vram for bisect.
+# Format: (min_vram, model_name, quantization, max_model_len)
+_VRAM_TIERS = (
+    # Below 8GB - use smaller context
+    (0, "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 2048),
+    # 8-12GB (RTX 3070, 4060 Ti, etc.)
+    (6, "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 4096),
+    # 12-16GB (RTX 4070, 3080 Ti, etc.)
+    (10, "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 8192),
+    # 16-20GB (RTX 4060 Ti 16GB, 4080, etc.) - long context 8B
+    (16, "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 32768),
+    # 24GB+ (RTX 3090, 4090, A5000, etc.)
+    (20, "hugging-quants/Meta-Llama-3.1-70B-Instruct-AWQ-INT4", "awq", 8192),
+)
+_VRAM_TIER_MINIMUMS = tuple(tier[0] for tier in _VRAM_TIERS)
+
+
+def select_model_by_vram(vram_gb, fp8_supported=False):
     """
     Select appropriate model based on available GPU VRAM.
+    On FP8-capable GPUs with enough headroom, prefer an FP8 W8A8 checkpoint
+    (no dequantization overhead) over weight-only AWQ.
     Returns (model_name, quantization, max_model_len)
     """
-    # Model configurations by VRAM tier (English-focused Llama models)
-    # Format: (min_vram, model_name, quantization, max_model_len)
-    model_configs = [
-        # 24GB+ (RTX 3090, 4090, A5000, etc.)
-        (20, "hugging-quants/Meta-Llama-3.1-70B-Instruct-AWQ-INT4", "awq", 8192),
-        # 12-24GB (RTX 4070, 3080 Ti, etc.)
-        (10, "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 8192),
-        # 8-12GB (RTX 3070, 4060 Ti, etc.)
-        (6, "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 4096),
-        # Below 8GB - use smaller context
-        (0, "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4", "awq", 2048),
-    ]
-    
-    for min_vram, model, quant, max_len in model_configs:
-        if vram_gb >= min_vram:
-            return model, quant, max_len
-    
-    # Fallback to smallest config
-    return model_configs[-1][1], model_configs[-1][2], model_configs[-1][3]
+    # FP8 8B needs ~9GB for weights alone; below 16GB AWQ leaves more room for KV cache.
+    # 16GB+ fits a 32k context for 8B (Llama 3.1 is trained to 128k), so
+    # typical result sets are analyzed directly without Map-Reduce.
+    if fp8_supported and 16 <= vram_gb < 20:
+        return "neuralmagic/Meta-Llama-3.1-8B-Instruct-FP8", "fp8", 32768
+
+    # Highest tier whose min_vram fits; below the lowest tier use the smallest
+    index = max(bisect_right(_VRAM_TIER_MINIMUMS, vram_gb) - 1, 0)
+    return _VRAM_TIERS[index][1:]
+
+
+# Separator between search results in the LLM context
+CONTEXT_SEPARATOR = "\n---\n"
+
+
+def format_search_result(idx, result, max_content_chars=10000):
+    """
+    Format one search result as an LLM context item.
+    Built with a single f-string so each item is one allocation.
+
+    Args:
+        idx: 1-based result number
+        result: Dict with keys: title, url, content
+        max_content_chars: Hard cap on content length
+
+    Returns:
+        "[결과 N]\n제목: ...\nURL: ...\n내용: ...\n"
+    """
+    content = result["content"][:max_content_chars] if result["content"] else ""
+    return f"[결과 {idx}]\n제목: {result['title']}\nURL: {result['url']}\n내용: {content}\n"
+
+
+def infer_quantization(model_name):
+    """
+    Guess the quantization method from a checkpoint name when
+    VLLM_QUANTIZATION is not set.
+
+    Returns:
+        "awq", "fp8" or None (unquantized FP16/BF16 weights)
+    """
+    name = model_name.lower()
+    if "awq" in name:
+        return "awq"
+    if "fp8" in name:
+        return "fp8"
+    return None
+
+
+def pack_chunks(item_lens, max_tokens, sep_len=0):
+    """
+    Greedily pack consecutive items into chunks of at most max_tokens
+    (counting separators), keeping the original order.
+
+    Args:
+        item_lens: Token length of each item
+        max_tokens: Token budget per chunk
+        sep_len: Token length of the separator placed between items
+
+    Returns:
+        List of chunks, each a list of item indices
+    """
+    chunks = []
+    current, current_tokens = [], 0
+    for i, n in enumerate(item_lens):
+        needed = n + (sep_len if current else 0)
+        if current and current_tokens + needed > max_tokens:
+            chunks.append(current)
+            current, needed = [], n
+            current_tokens = 0
+        current.append(i)
+        current_tokens += needed
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# Llama 3.1 RoPE scaling as published in the reference config.json. Some
+# quantized re-uploads ship incomplete values, which broke CUDA graph runs.
+LLAMA31_ROPE_SCALING = {
+    "rope_type": "llama3",
+    "factor": 8.0,
+    "low_freq_factor": 1.0,
+    "high_freq_factor": 4.0,
+    "original_max_position_embeddings": 8192,
+}
+
+
+def get_rope_scaling(model_name):
+    """
+    Return an explicit rope_scaling override for the model, or None to keep
+    the checkpoint's own config.
+    """
+    name = model_name.lower()
+    if "llama-3.1" in name or "llama-3_1" in name:
+        return dict(LLAMA31_ROPE_SCALING)
+    return None
+
+
+def adaptive_max_tokens(n_prompt_tokens, cap=1536, base=512):
+    """
+    Scale the decode budget with the prompt instead of always reserving the
+    worst case, so the scheduler can fit more sequences in the KV cache.
+
+    Args:
+        n_prompt_tokens: Length of the tokenized prompt
+        cap: Upper bound (the previous fixed max_tokens)
+        base: Budget for a near-empty prompt
+
+    Returns:
+        max_tokens for SamplingParams
+    """
+    return min(cap, base + n_prompt_tokens // 8)
+
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?。])\s+|\n+")
+_WORD = re.compile(r"\w+")
+
+
+def _bm25_terms(text):
+    """
+    Tokenize text for BM25 scoring.
+    ASCII words are kept whole; Korean (and other non-ASCII) words are split
+    into character bigrams so particles (e.g. "인공지능의") still match "인공지능".
+    """
+    terms = []
+    for word in _WORD.findall(text.lower()):
+        if word.isascii() or len(word) < 2:
+            terms.append(word)
+        else:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+
+def rank_sentences(content, topic, max_chars, k1=1.5, b=0.75):
+    """
+    Compress content to at most ~max_chars by keeping the sentences most
+    relevant to the topic (BM25 over sentences), in their original order.
+    Content that already fits is returned unchanged.
+
+    Args:
+        content: Crawled page text
+        topic: User topic (BM25 query)
+        max_chars: Character budget for the compressed content
+
+    Returns:
+        Compressed content string
+    """
+    if not content or len(content) <= max_chars:
+        return content
+
+    sentences = [s.strip() for s in _SENTENCE_SPLIT.split(content) if s.strip()]
+    docs = [_bm25_terms(sentence) for sentence in sentences]
+    query = set(_bm25_terms(topic))
+    if not docs or not query:
+        return content[:max_chars]
+
+    n_docs = len(docs)
+    avg_len = sum(len(doc) for doc in docs) / n_docs or 1
+    doc_freq = Counter(term for doc in docs for term in set(doc) if term in query)
+
+    def score(doc):
+        tf = Counter(doc)
+        total = 0.0
+        for term in query:
+            if not tf[term]:
+                continue
+            idf = math.log(1 + (n_docs - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            norm = tf[term] + k1 * (1 - b + b * len(doc) / avg_len)
+            total += idf * tf[term] * (k1 + 1) / norm
+        return total
+
+    # Greedily take the best matching sentences until the budget is used
+    scores = [score(doc) for doc in docs]
+    ranked = sorted((i for i in range(n_docs) if scores[i] > 0), key=lambda i: -scores[i])
+    keep, used = set(), 0
+    for i in ranked:
+        if used + len(sentences[i]) > max_chars:
+            continue
+        keep.add(i)
+        used += len(sentences[i]) + 1
+
+    if not keep:
+        return content[:max_chars]
+    return " ".join(sentences[i] for i in sorted(keep))
@@ -1,9 +1,14 @@
-from sqlalchemy import create_engine, Column, String, Text, Integer, DateTime, ForeignKey
+from sqlalchemy import (
+    create_engine, make_url, func, text, Column, String, Text, Integer, DateTime, ForeignKey,
+    Index, FetchedValue,
+)
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.dialects.postgresql import UUID
+import os
 import uuid
-from datetime import datetime
+from functools import lru_cache
 from common.config import settings
 
 Base = declarative_base()
@@ -15,14 +20,40 @@ class Request(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     topic = Column(Text, nullable=False)
     status = Column(String(20), nullable=False, default='pending')  # pending, searching, analyzing, completed, failed
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Timestamps come from the DB clock: NOW() defaults, and updated_at is
+    # maintained by the update_requests_updated_at trigger (init.sql)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), server_onupdate=FetchedValue())
     completed_at = Column(DateTime)
     error_message = Column(Text)
+    partial_summary = Column(Text)  # Summary generated so far (streaming)
+    # Denormalized COUNT of search_results, written by the search worker in
+    # the same transaction as the rows
+    search_results_count = Column(Integer, nullable=False, default=0, server_default="0")
     
     # Relationships
-    search_results = relationship("SearchResult", back_populates="request", cascade="all, delete-orphan")
-    analysis_result = relationship("AnalysisResult", back_populates="request", uselist=False, cascade="all, delete-orphan")
+    # raise_on_sql: an unloaded relationship raises instead of issuing one
+    # SELECT per row (N+1); load it explicitly with selectinload/joinedload.
+    # passive_deletes: the FKs are ON DELETE CASCADE, so deleting a request
+    # doesn't need to load its children first.
+    search_results = relationship(
+        "SearchResult", back_populates="request", cascade="all, delete-orphan",
+        lazy="raise_on_sql", passive_deletes=True,
+    )
+    analysis_result = relationship(
+        "AnalysisResult", back_populates="request", uselist=False, cascade="all, delete-orphan",
+        lazy="raise_on_sql", passive_deletes=True,
+    )
+
+    # Fetch server-generated timestamps with RETURNING on INSERT/UPDATE
+    # instead of a follow-up SELECT (or an async lazy load)
+    __mapper_args__ = {"eager_defaults": True}
+
+    # Same indexes as src/database/init.sql
+    __table_args__ = (
+        Index('idx_requests_status_created_at', 'status', created_at.desc(), id.desc()),
+        Index('idx_requests_created_at', created_at.desc(), id.desc()),
+    )
 
 # SearchResult model: Stores search results
 class SearchResult(Base):
@@ -33,11 +64,13 @@ class SearchResult(Base):
     url = Column(Text, nullable=False)
     title = Column(Text)
     content = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, server_default=func.now())
     
     # Relationship
     request = relationship("Request", back_populates="search_results")
 
+    __table_args__ = (Index('idx_search_results_request_id', 'request_id'),)
+
 # AnalysisResult model: Stores AI analysis results
 class AnalysisResult(Base):
     __tablename__ = 'analysis_results'
@@ -47,27 +80,159 @@ class AnalysisResult(Base):
     summary = Column(Text, nullable=False)
     tokens_used = Column(Integer)
     inference_time_ms = Column(Integer)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, server_default=func.now())
     
     # Relationship
     request = relationship("Request", back_populates="analysis_result")
 
+    __table_args__ = (Index('idx_analysis_results_request_id', 'request_id'),)
+
 # Database connection setup
-engine = create_engine(
-    settings.DATABASE_URL,
+# Bounded pool: ~2 connections per core (capped at 20), no overflow, and a
+# short pool_timeout so saturation fails fast instead of queueing requests.
+# Connections are opened lazily, so small workers never open the full pool.
+POOL_OPTIONS = dict(
+    pool_size=settings.DB_POOL_SIZE or min(2 * (os.cpu_count() or 1), 20),
+    max_overflow=0,
+    pool_timeout=5,
+    pool_recycle=1800,  # Drop connections before server-side idle timeouts
     pool_pre_ping=True,  # Validate connection before use
-    pool_size=5,
-    max_overflow=10
 )
 
+engine = create_engine(settings.DATABASE_URL, **POOL_OPTIONS)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+@lru_cache(maxsize=1)
+def get_async_sessionmaker():
+    """
+    Async (asyncpg) session factory for the API server, created on first use
+    so the workers never need asyncpg installed.
+    """
+    async_engine = create_async_engine(
+        make_url(settings.DATABASE_URL).set(drivername="postgresql+asyncpg"),
+        **POOL_OPTIONS,  # AsyncAdaptedQueuePool with the same sizing
+    )
+    # expire_on_commit=False: attributes stay readable after commit without
+    # an implicit (async-incompatible) refresh
+    return async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
 # Dependency for FastAPI
-def get_db():
-    """Database session dependency"""
-    db = SessionLocal()
-    print("postgreSQL connected!")
-    try:
+async def get_db():
+    """Async database session dependency"""
+    async with get_async_sessionmaker()() as db:
         yield db
-    finally:
-        db.close()
+
+
+# init.sql only runs on an empty postgres volume. These bring a database
+# created by an older init.sql up to date and run on each API start (keep
+# them in step with init.sql). Every step checks the catalog first, so an
+# up-to-date database takes no lock on requests: a bare ALTER TABLE or
+# CREATE TRIGGER would block the workers' UPDATEs until commit.
+SCHEMA_MIGRATIONS = (
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'requests' AND column_name = 'partial_summary'
+        ) THEN
+            ALTER TABLE requests ADD COLUMN partial_summary TEXT;
+        END IF;
+    END $$
+    """,
+    # Added with a one-time backfill of the existing rows (without bumping
+    # their updated_at)
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'requests' AND column_name = 'search_results_count'
+        ) THEN
+            ALTER TABLE requests ADD COLUMN search_results_count INTEGER NOT NULL DEFAULT 0;
+            ALTER TABLE requests DISABLE TRIGGER update_requests_updated_at;
+            UPDATE requests r SET search_results_count = (
+                SELECT COUNT(*) FROM search_results s WHERE s.request_id = r.id
+            );
+            ALTER TABLE requests ENABLE TRIGGER update_requests_updated_at;
+        END IF;
+    END $$
+    """,
+    # Replacing a function doesn't lock the table
+    """
+    CREATE OR REPLACE FUNCTION notify_request_update()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM pg_notify('request_updates', NEW.id::text);
+        RETURN NULL;
+    END;
+    $$ language 'plpgsql'
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgname = 'notify_requests_update' AND tgrelid = 'requests'::regclass
+        ) THEN
+            CREATE TRIGGER notify_requests_update AFTER UPDATE OF status, partial_summary ON requests
+                FOR EACH ROW
+                WHEN (OLD.status IS DISTINCT FROM NEW.status
+                      OR OLD.partial_summary IS DISTINCT FROM NEW.partial_summary)
+                EXECUTE FUNCTION notify_request_update();
+        END IF;
+    END $$
+    """,
+)
+# Index builds run CONCURRENTLY, outside any transaction, so writes go on
+# while they build: (name, definition as pg_indexes shows it). A missing,
+# invalid (failed concurrent build) or outdated index is (re)built.
+INDEX_MIGRATIONS = (
+    ("idx_requests_status_created_at", "ON requests(status, created_at DESC, id DESC)"),
+    ("idx_requests_created_at", "ON requests(created_at DESC, id DESC)"),
+)
+# Superseded by idx_requests_status_created_at
+DROPPED_INDEXES = ("idx_requests_status",)
+# pg_advisory_lock key: API replicas starting together migrate one at a time
+MIGRATION_LOCK_KEY = 0x61692D6167656E74
+
+INDEX_STATE_QUERY = text("""
+    SELECT i.indexdef, x.indisvalid
+    FROM pg_indexes i
+    JOIN pg_index x ON x.indexrelid = to_regclass(i.indexname)
+    WHERE i.tablename = 'requests' AND i.indexname = :name
+""")
+
+
+def _index_columns(definition):
+    """'ON requests(a, b DESC)' -> '(a, b DESC)', the tail of pg_indexes.indexdef"""
+    return definition[definition.index("("):]
+
+
+async def migrate_schema(engine):
+    """
+    Apply SCHEMA_MIGRATIONS, then INDEX_MIGRATIONS and DROPPED_INDEXES, on one
+    autocommit connection (CREATE INDEX CONCURRENTLY can't run in a transaction)
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            # Each step is a single statement (DO blocks included), so each is atomic
+            for statement in SCHEMA_MIGRATIONS:
+                await conn.execute(text(statement))
+
+            for name, definition in INDEX_MIGRATIONS:
+                state = (await conn.execute(INDEX_STATE_QUERY, {"name": name})).first()
+                if state and state.indisvalid and state.indexdef.endswith(_index_columns(definition)):
+                    continue
+                if state:
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+                await conn.execute(text(f"CREATE INDEX CONCURRENTLY {name} {definition}"))
+            for name in DROPPED_INDEXES:
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
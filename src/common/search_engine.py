@@ -3,10 +3,16 @@ Search engine abstraction layer.
 Supports DuckDuckGo and SearXNG backends.
 """
 import time
+import logging
+import threading
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
 from typing import List, Dict, Optional
 from common.config import settings
 
+logger = logging.getLogger(__name__)
+
 
 class SearchEngine:
     """Base class for search engines."""
@@ -23,14 +29,24 @@ class SearchEngine:
 
 class DuckDuckGoSearch(SearchEngine):
     """DuckDuckGo search implementation."""
+
+    def __init__(self):
+        # One long-lived DDGS client (created on first search) so its
+        # HTTP connection and TLS session are reused across queries
+        self._ddgs = None
+        # The client isn't thread-safe, and parallel queries from one IP hit
+        # DuckDuckGo's rate limit; searches run one at a time
+        self._lock = threading.Lock()
     
     def search(self, query: str, max_results: int = 10) -> List[Dict]:
         from duckduckgo_search import DDGS
         
         results = []
         try:
-            with DDGS() as ddgs:
-                search_results = list(ddgs.text(query, max_results=max_results))
+            with self._lock:
+                if self._ddgs is None:
+                    self._ddgs = DDGS()
+                search_results = list(self._ddgs.text(query, max_results=max_results))
                 
             for r in search_results:
                 results.append({
@@ -39,7 +55,9 @@ class DuckDuckGoSearch(SearchEngine):
                     "snippet": r.get("body", ""),
                 })
         except Exception as e:
-            print(f"❌ DuckDuckGo search error: {e}")
+            logger.error("❌ DuckDuckGo search error: %s", e)
+            # Start from a fresh client next time
+            self._ddgs = None
         
         return results
 
@@ -56,6 +74,13 @@ class SearXNGSearch(SearchEngine):
         """
         self.base_url = base_url.rstrip("/")
         self.search_endpoint = f"{self.base_url}/search"
+        # Pooled keep-alive connections to the SearXNG instance
+        self._session = requests.Session()
+        self._session.mount(self.base_url, HTTPAdapter(pool_connections=10, pool_maxsize=50))
+        self._session.headers.update({
+            "Accept": "application/json",
+            "User-Agent": "AI-Agent-Search-Worker/1.0",
+        })
     
     def search(self, query: str, max_results: int = 10) -> List[Dict]:
         """
@@ -78,16 +103,10 @@ class SearXNGSearch(SearchEngine):
             "pageno": 1,
         }
         
-        headers = {
-            "Accept": "application/json",
-            "User-Agent": "AI-Agent-Search-Worker/1.0",
-        }
-        
         try:
-            response = requests.get(
+            response = self._session.get(
                 self.search_endpoint,
                 params=params,
-                headers=headers,
                 timeout=30
             )
             response.raise_for_status()
@@ -102,13 +121,13 @@ class SearXNGSearch(SearchEngine):
                     "snippet": r.get("content", ""),
                 })
             
-            print(f"✅ SearXNG returned {len(results)} results")
+            logger.info("✅ SearXNG returned %d results", len(results))
             
         except requests.exceptions.RequestException as e:
-            print(f"❌ SearXNG request error: {e}")
+            logger.error("❌ SearXNG request error: %s", e)
         except ValueError as e:
-            print(f"❌ SearXNG JSON parse error: {e}")
-            print("💡 Tip: Make sure JSON format is enabled in SearXNG settings.yml")
+            logger.error("❌ SearXNG JSON parse error: %s", e)
+            logger.error("💡 Tip: Make sure JSON format is enabled in SearXNG settings.yml")
         
         return results
 
@@ -116,18 +135,22 @@ class SearXNGSearch(SearchEngine):
 def get_search_engine() -> SearchEngine:
     """
     Factory function to get the configured search engine.
+    The instance (and its pooled connections) is shared per configuration.
     
     Returns:
         SearchEngine instance based on SEARCH_ENGINE setting
     """
-    engine = settings.SEARCH_ENGINE.lower()
-    
+    return _build_search_engine(settings.SEARCH_ENGINE.lower(), settings.SEARXNG_URL)
+
+
+@lru_cache(maxsize=None)
+def _build_search_engine(engine: str, searxng_url: Optional[str]) -> SearchEngine:
     if engine == "searxng":
-        if not settings.SEARXNG_URL:
-            print("⚠️  SEARXNG_URL not set, falling back to DuckDuckGo")
+        if not searxng_url:
+            logger.warning("⚠️  SEARXNG_URL not set, falling back to DuckDuckGo")
             return DuckDuckGoSearch()
-        print(f"🔍 Using SearXNG at {settings.SEARXNG_URL}")
-        return SearXNGSearch(settings.SEARXNG_URL)
+        logger.info("🔍 Using SearXNG at %s", searxng_url)
+        return SearXNGSearch(searxng_url)
     else:
-        print("🔍 Using DuckDuckGo Search")
+        logger.info("🔍 Using DuckDuckGo Search")
         return DuckDuckGoSearch()
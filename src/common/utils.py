@@ -1,89 +1,173 @@
-import json, time, sys, signal
-from kafka import KafkaProducer, KafkaConsumer, errors
+import time, sys, signal, atexit, logging, queue, hashlib
+import orjson
+from logging.handlers import QueueHandler, QueueListener
+from kafka import KafkaProducer, KafkaConsumer, TopicPartition, OffsetAndMetadata, errors
 from common.config import settings
 
 KAFKA_SERVER = (
     settings.KAFKA_BROKER if settings.KAFKA_BROKER else settings.KAFKA_BOOTSTRAP_SERVERS
 )
-# Print current Kafka broker address for debugging
-print(f"🔗 [Utils] Connecting to Kafka Brokers: {KAFKA_SERVER}")
+
+logger = logging.getLogger(__name__)
+_log_listener = None
+
+
+def setup_logging(name):
+    """
+    Return a logger whose records are written to stdout by a background thread.
+    Hot-path threads only enqueue records (QueueHandler); a single
+    QueueListener does the formatting and blocking stdout writes.
+    """
+    global _log_listener
+    if _log_listener is None:
+        log_queue = queue.SimpleQueue()
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+        )
+        _log_listener = QueueListener(log_queue, handler)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+
+        root = logging.getLogger()
+        root.addHandler(QueueHandler(log_queue))
+        root.setLevel(settings.LOG_LEVEL)
+    return logging.getLogger(name)
+
+
+def _parse_acks(acks):
+    """KAFKA_PRODUCER_ACKS as kafka-python expects it (0, 1 or 'all')"""
+    return acks if acks == "all" else int(acks)
+
+
+def message_key(text):
+    """
+    Short partition key for a search topic: the same topic always goes to
+    the same partition (and so the same worker and its caches).
+    Hashed first so the partitioner never murmur2-hashes a long string.
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
 
 
 class KafkaProducerWrapper:
-    def __init__(self, max_retries=10, initial_delay=2):
-        print("🔧 Initializing Kafka Producer...")
-        self.producer = self._create_producer_with_retry(max_retries, initial_delay)
+    def __init__(self, max_retries=10, initial_delay=2, exit_on_failure=True):
+        """
+        exit_on_failure: workers exit when Kafka can't be reached; with False
+        the connect error is raised instead (for callers that can recover).
+        """
+        logger.info("🔧 Initializing Kafka Producer (%s)...", KAFKA_SERVER)
+        self.producer = self._create_producer_with_retry(max_retries, initial_delay, exit_on_failure)
+        # Lingering batches are only flushed on real shutdown, never per send
+        self._closed = False
+        atexit.register(self.close)
 
-    def _create_producer_with_retry(self, max_retries, delay):
+    def _create_producer_with_retry(self, max_retries, delay, exit_on_failure=True):
         attempt = 0
         while attempt < max_retries:
             try:
                 producer = KafkaProducer(
                     bootstrap_servers=[KAFKA_SERVER],
-                    value_serializer=lambda x: json.dumps(x).encode("utf-8"),
-                    compression_type="gzip",
+                    value_serializer=orjson.dumps,
+                    # Wait up to linger_ms to fill batches; lz4 is much
+                    # cheaper than gzip for small JSON payloads
+                    linger_ms=settings.KAFKA_LINGER_MS,
+                    batch_size=settings.KAFKA_BATCH_SIZE,
+                    compression_type="lz4",
+                    # Leader ack only by default; the DB row, not the task
+                    # message, is the source of truth for request state
+                    acks=_parse_acks(settings.KAFKA_PRODUCER_ACKS),
+                    max_in_flight_requests_per_connection=5,
+                    buffer_memory=64 * 1024 * 1024,
                     api_version_auto_timeout_ms=5000,
                 )
-                print("✅ Kafka Producer Connected!")
+                logger.info("✅ Kafka Producer Connected!")
                 return producer
             except errors.NoBrokersAvailable:
                 attempt += 1
-                print(
-                    f"⚠️ Producer Connection Failed ({attempt}/{max_retries}). Retrying in {delay}s..."
+                logger.warning(
+                    "⚠️ Producer Connection Failed (%d/%d). Retrying in %ss...",
+                    attempt, max_retries, delay,
                 )
                 time.sleep(delay)
                 delay *= 2
             except Exception as e:
-                print(f"❌ Producer Error: {e}")
+                logger.exception("❌ Producer Error: %s", e)
+                if not exit_on_failure:
+                    raise
                 sys.exit(1)
 
-        print("🚨 Producer failed to connect. Exiting...")
+        if not exit_on_failure:
+            logger.error("🚨 Producer failed to connect after %d attempts", max_retries)
+            raise errors.NoBrokersAvailable()
+        logger.critical("🚨 Producer failed to connect. Exiting...")
         sys.exit(1)
 
-    def send_data(self, topic, value, callback=None):
+    def send_data(self, topic, value, callback=None, key=None):
         """
-        Generic method to send any data to any topic
+        Generic method to send any data to any topic.
+        key: optional partition key (bytes); equal keys land on one partition.
+        Returns the send future; failures are logged either way.
         """
-        future = self.producer.send(topic, value=value)
+        future = self.producer.send(topic, value=value, key=key)
         if callback:
             future.add_callback(callback)
         future.add_errback(self._on_error)
         # Avoid calling flush on every send for performance; use batch processing instead
+        return future
 
     def _on_error(self, exc):
-        print(f"❌ Failed to send: {exc}")
-
-    def get_messages(self):
-        """Generator that yields messages one by one (with graceful exit)"""
-        # Set to True when shutdown signal is received
-        self._stop_event = False
-
-        def signal_handler(sig, frame):
-            print(f"\n🛑 Received signal {sig}. Stopping producer loop...")
-            self._stop_event = True
-
-        # Catch SIGINT (Ctrl+C) and SIGTERM (Docker stop)
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+        logger.error("❌ Failed to send: %s", exc)
 
-        self.close()
-
-        print("👋 Producer loop finished.")
-
-    def close(self):
-        self.producer.flush()
-        self.producer.close()
+    def close(self, timeout=10):
+        """Flush pending batches and close (runs at exit; safe to call twice)"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.producer.flush(timeout=timeout)
+        except Exception as e:
+            logger.error("❌ Final producer flush failed: %s", e)
+        self.producer.close(timeout=timeout)
 
 
 class KafkaConsumerWrapper:
-    def __init__(self, topic, group_id, max_retries=10, initial_delay=2):
+    # Deeper fetches for bulk consumers (the saver): the broker holds each
+    # fetch until 64KB is ready or 200ms pass. Not for the request path,
+    # where small messages would wait out fetch_max_wait_ms.
+    HIGH_THROUGHPUT = dict(
+        fetch_min_bytes=64 * 1024,
+        fetch_max_wait_ms=200,
+        max_partition_fetch_bytes=4 * 1024 * 1024,
+        max_poll_records=256,
+    )
+
+    def __init__(
+        self, topic, group_id, max_retries=10, initial_delay=2, max_poll_records=500,
+        fetch_min_bytes=1, fetch_max_wait_ms=500, max_partition_fetch_bytes=1024 * 1024,
+    ):
         """
-        Initialize consumer with topic and group_id for maximum reusability
+        Initialize consumer with topic and group_id for maximum reusability.
+        max_poll_records caps how many records one fetch hands to the client;
+        keep it low for slow per-message work so the loop polls again within
+        max_poll_interval_ms. The fetch defaults match kafka-python's.
+        Fetch buffers can reach max_partition_fetch_bytes * assigned partitions.
         """
-        print(f"🔧 Initializing Kafka Consumer (Group: {group_id}, Topic: {topic})...")
+        logger.info(
+            "🔧 Initializing Kafka Consumer (%s, Group: %s, Topic: %s)...",
+            KAFKA_SERVER, group_id, topic,
+        )
         self.topic = topic
         self.group_id = group_id
+        self.max_poll_records = max_poll_records
+        self.fetch_options = dict(
+            fetch_min_bytes=fetch_min_bytes,
+            fetch_max_wait_ms=fetch_max_wait_ms,
+            max_partition_fetch_bytes=max_partition_fetch_bytes,
+        )
         self.consumer = self._create_consumer_with_retry(max_retries, initial_delay)
+        # Latest offsets sent with commit_async, re-committed synchronously at exit
+        self._async_offsets = {}
+        atexit.register(self.flush_commits)
 
     def _create_consumer_with_retry(self, max_retries, delay):
         attempt = 0
@@ -95,40 +179,103 @@ class KafkaConsumerWrapper:
                     group_id=self.group_id,
                     auto_offset_reset="earliest",
                     enable_auto_commit=False,  # Manual commit to prevent duplicate analysis
-                    value_deserializer=lambda x: json.loads(x.decode("utf-8")),
+                    max_poll_records=self.max_poll_records,
+                    value_deserializer=orjson.loads,
+                    **self.fetch_options,
                 )
-                print("✅ Kafka Consumer Connected!")
+                logger.info("✅ Kafka Consumer Connected!")
                 return consumer
             except errors.NoBrokersAvailable:
                 attempt += 1
-                print(
-                    f"⚠️ Consumer Connection Failed ({attempt}/{max_retries}). Retrying in {delay}s..."
+                logger.warning(
+                    "⚠️ Consumer Connection Failed (%d/%d). Retrying in %ss...",
+                    attempt, max_retries, delay,
                 )
                 time.sleep(delay)
                 delay *= 2
             except Exception as e:
-                print(f"❌ Consumer Error: {e}")
+                logger.exception("❌ Consumer Error: %s", e)
                 sys.exit(1)
 
-        print("🚨 Consumer failed to connect. Exiting...")
+        logger.critical("🚨 Consumer failed to connect. Exiting...")
         sys.exit(1)
 
-    def get_messages(self):
-        """Generator that yields messages one by one (with graceful exit)"""
+    def _install_signal_handlers(self):
         # Set to True when shutdown signal is received
         self._stop_event = False
 
         def signal_handler(sig, frame):
-            print(f"\n🛑 Received signal {sig}. Stopping consumer loop...")
+            logger.info("🛑 Received signal %s. Stopping consumer loop...", sig)
             self._stop_event = True
 
         # Catch SIGINT (Ctrl+C) and SIGTERM (Docker stop)
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
 
+    def get_messages(self):
+        """Generator that yields messages one by one (with graceful exit)"""
+        self._install_signal_handlers()
+
         for message in self.consumer:
             if self._stop_event:
                 break
             yield message
 
-        print("👋 Consumer loop finished.")
+        logger.info("👋 Consumer loop finished.")
+
+    def get_batches(self, max_records=8, timeout_ms=50):
+        """
+        Generator that yields micro-batches (lists of up to max_records messages)
+        drained with a single poll() call (with graceful exit).
+        Yields an empty list when a poll times out so callers can do housekeeping.
+        """
+        self._install_signal_handlers()
+
+        while not self._stop_event:
+            records = self.consumer.poll(timeout_ms=timeout_ms, max_records=max_records)
+            yield [message for messages in records.values() for message in messages]
+
+        logger.info("👋 Consumer loop finished.")
+
+    def commit_offsets(self, messages, asynchronous=False):
+        """
+        Commit offsets for exactly these messages instead of the consumer's
+        current position (which may already include prefetched messages).
+        With asynchronous=True the commit doesn't wait for the broker; the
+        latest offsets are committed synchronously again by flush_commits().
+        """
+        offsets = {}
+        for message in messages:
+            tp = TopicPartition(message.topic, message.partition)
+            offsets[tp] = max(offsets.get(tp, 0), message.offset + 1)
+
+        if not offsets:
+            return
+
+        offsets = {tp: OffsetAndMetadata(offset, "", -1) for tp, offset in offsets.items()}
+        if asynchronous:
+            self._async_offsets.update(offsets)
+            self.consumer.commit_async(offsets, callback=self._on_commit)
+        else:
+            self.consumer.commit(offsets)
+
+    @staticmethod
+    def _on_commit(offsets, response):
+        if isinstance(response, Exception):
+            logger.warning("⚠️ Async offset commit failed: %s", response)
+
+    def flush_commits(self):
+        """
+        Synchronously commit the latest async offsets (runs at exit).
+        Partitions revoked by a rebalance since are skipped: their new owner
+        may already have committed further.
+        """
+        assigned = self.consumer.assignment()
+        offsets = {tp: om for tp, om in self._async_offsets.items() if tp in assigned}
+        self._async_offsets.clear()
+        if not offsets:
+            return
+        try:
+            self.consumer.commit(offsets)
+        except Exception as e:
+            logger.error("❌ Final offset commit failed: %s", e)
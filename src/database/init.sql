@@ -1,4 +1,6 @@
 -- AI Agent Database Schema
+-- Runs on an empty volume only; existing databases are upgraded at API
+-- startup by migrate_schema (src/common/database.py). Keep both in step.
 -- UUID extension for request IDs
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
@@ -11,11 +13,16 @@ CREATE TABLE requests (
     created_at TIMESTAMP DEFAULT NOW(),
     updated_at TIMESTAMP DEFAULT NOW(),
     completed_at TIMESTAMP,
-    error_message TEXT
+    error_message TEXT,
+    partial_summary TEXT,  -- streamed while processing_analysis, cleared on completion
+    search_results_count INTEGER NOT NULL DEFAULT 0  -- set with the search_results insert
 );
 
-CREATE INDEX idx_requests_status ON requests(status);
-CREATE INDEX idx_requests_created_at ON requests(created_at DESC);
+-- (status, created_at, id): status lookups, the status-filtered dashboard list
+-- ordered by created_at (id breaks ties for keyset pagination), and
+-- index-only scans for the metrics aggregates
+CREATE INDEX idx_requests_status_created_at ON requests(status, created_at DESC, id DESC);
+CREATE INDEX idx_requests_created_at ON requests(created_at DESC, id DESC);
 
 -- Search results table
 CREATE TABLE search_results (
@@ -52,3 +59,19 @@ $$ language 'plpgsql';
 
 CREATE TRIGGER update_requests_updated_at BEFORE UPDATE ON requests
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+-- Push progress to /stream/{id} listeners: NOTIFY request_updates with the
+-- request id whenever status or the partial summary changes (delivered on commit)
+CREATE OR REPLACE FUNCTION notify_request_update()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('request_updates', NEW.id::text);
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER notify_requests_update AFTER UPDATE OF status, partial_summary ON requests
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status
+          OR OLD.partial_summary IS DISTINCT FROM NEW.partial_summary)
+    EXECUTE FUNCTION notify_request_update();
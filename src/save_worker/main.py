@@ -1,52 +1,124 @@
-# src/saver/main.py
-import os, json, time, uuid
+# src/save_worker/main.py
+import io, time, uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 import boto3
+from boto3.s3.transfer import TransferConfig
+import orjson
 from botocore.client import Config as BotoConfig
-import src.common.config as config, src.common.utils as utils
+from common.config import settings
+from common.utils import KAFKA_SERVER, KafkaConsumerWrapper, setup_logging
+
+logger = setup_logging("save_worker")
+
+# Concurrent PUTs per batch; also the S3 client's connection pool size
+SAVE_WORKERS = 32
+SAVE_BATCH_SIZE = 64
+# Bodies this large go up as parallel multipart parts; smaller ones are a
+# single put_object (upload_fileobj would add its own thread pool per call)
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+)
 
 
 def get_s3_client():
     """Connect to MinIO (S3 compatible)"""
     return boto3.client(
         "s3",
-        endpoint_url=config.MINIO_ENDPOINT,
-        aws_access_key_id=config.MINIO_ACCESS_KEY,
-        aws_secret_access_key=config.MINIO_SECRET_KEY,
-        config=BotoConfig(signature_version="s3v4"),
+        endpoint_url=settings.MINIO_ENDPOINT,
+        aws_access_key_id=settings.MINIO_ACCESS_KEY,
+        aws_secret_access_key=settings.MINIO_SECRET_KEY,
+        config=BotoConfig(
+            signature_version="s3v4",
+            max_pool_connections=SAVE_WORKERS,  # One connection per in-flight PUT
+            retries={"mode": "adaptive", "total_max_attempts": 5},
+        ),
         region_name="us-east-1",  # MinIO doesn't care about region, but required for format
     )
 
 
+def save_message(s3, data):
+    """Upload one message to S3 from memory (UUID filename to prevent duplicates)"""
+    file_name = f"{uuid.uuid4()}.json"
+    body = orjson.dumps(data)  # UTF-8 bytes, non-ASCII kept as-is
+    if len(body) >= MULTIPART_THRESHOLD:
+        s3.upload_fileobj(
+            io.BytesIO(body), settings.MINIO_BUCKET_NAME, file_name,
+            Config=TRANSFER_CONFIG, ExtraArgs={"ContentType": "application/json"},
+        )
+    else:
+        s3.put_object(
+            Bucket=settings.MINIO_BUCKET_NAME,
+            Key=file_name,
+            Body=body,
+            ContentType="application/json",
+        )
+    return file_name
+
+
 def run_saver():
     # 1. Connect to Kafka Consumer
-    print(f"🔌 Connecting to Kafka ({config.KAFKA_BROKER})...")
-    consumer = utils.KafkaConsumerWithRetry().consumer
+    logger.info("🔌 Connecting to Kafka (%s)...", KAFKA_SERVER)
+    consumer = KafkaConsumerWrapper(
+        topic=settings.KAFKA_TOPIC_RAW, group_id="saver-group",
+        **KafkaConsumerWrapper.HIGH_THROUGHPUT,
+    )
 
-    # 2. Connect to S3 (MinIO)
+    # 2. Connect to S3 (MinIO); boto3 clients are thread-safe, so one is shared
     s3 = get_s3_client()
-    print(f"✅ Connected to MinIO. Listening to {config.KAFKA_TOPIC_RAW}...")
+    logger.info("✅ Connected to MinIO. Listening to %s...", settings.KAFKA_TOPIC_RAW)
 
-    # 3. Message loop
-    for message in consumer:
-        data = message.value
-        url = data.get("url", "no-url")
+    # 3. Message loop: one poll per batch, PUTs run concurrently so their
+    # round trips overlap. A batch's PUTs keep running while the next batch
+    # is polled; its offsets are committed once they are done. A failed PUT
+    # raises out of the loop (see finish_batch) and the process restarts.
+    with ThreadPoolExecutor(max_workers=SAVE_WORKERS) as executor:
+        in_flight = None
+        for batch in consumer.get_batches(max_records=SAVE_BATCH_SIZE, timeout_ms=200):
+            submitted = submit_batch(executor, s3, batch) if batch else None
+            if in_flight:
+                finish_batch(consumer, *in_flight)
+            in_flight = submitted
 
-        # Generate filename (UUID to prevent duplicates)
-        file_name = f"{uuid.uuid4()}.json"
+        if in_flight:
+            finish_batch(consumer, *in_flight)
+
+
+def submit_batch(executor, s3, batch):
+    """Start the PUTs for a batch; returns (batch, {future: message})"""
+    futures = {executor.submit(save_message, s3, message.value): message for message in batch}
+    return batch, futures
 
-        try:
-            # Upload directly to S3 from memory
-            s3.put_object(
-                Bucket=config.MINIO_BUCKET_NAME,
-                Key=file_name,
-                Body=json.dumps(data, ensure_ascii=False),
-                ContentType="application/json",
-            )
-            print(f"💾 Saved: {file_name} (Source: {url})")
 
+def finish_batch(consumer, batch, futures):
+    """
+    Wait for a batch's PUTs, log them and commit their offsets.
+    On each partition only the messages before the first failed PUT are
+    committed; the saver then stops, so the rest is redelivered on restart
+    instead of being skipped by the next batch's commit.
+    """
+    wait(futures)
+
+    saved, committable, failed = 0, [], set()
+    for future, message in futures.items():  # In batch (per-partition offset) order
+        partition = (message.topic, message.partition)
+        url = message.value.get("url", "no-url")
+        try:
+            logger.debug("💾 Saved: %s (Source: %s)", future.result(), url)
+            saved += 1
         except Exception as e:
-            print(f"❌ Failed to save to MinIO: {e}")
+            logger.error("❌ Failed to save %s to MinIO: %s", url, e)
+            failed.add(partition)
+            continue
+        if partition not in failed:
+            committable.append(message)
+    logger.info("💾 Saved %d/%d messages", saved, len(futures))
 
+    consumer.commit_offsets(committable, asynchronous=True)
+    if failed:
+        raise RuntimeError(f"{len(futures) - saved} message(s) not saved; stopping before their offsets")
 
 if __name__ == "__main__":
     # Wait for MinIO to be ready (simple logic to replace K8s initContainer)
@@ -1,10 +1,256 @@
+import threading
 import time
-import trafilatura
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sqlalchemy import insert, select, text
 from common.config import settings
-from common.utils import KafkaConsumerWrapper, KafkaProducerWrapper
+from common.utils import KafkaConsumerWrapper, KafkaProducerWrapper, setup_logging
 from common.database import SessionLocal, Request, SearchResult
+from common.extraction import MAX_HTML_BYTES, MIN_TEXT_CHARS, extract_text
 from common.search_engine import get_search_engine
 
+logger = setup_logging("search_worker")
+
+CLAIM_QUERY = text("""
+    UPDATE requests
+    SET status = 'processing_search'
+    WHERE id = (
+        SELECT id
+        FROM requests
+        WHERE id = :request_id
+        AND status = 'searching'
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, topic
+""")
+
+ANALYZING_QUERY = text("""
+    UPDATE requests
+    SET status = 'analyzing', search_results_count = :search_results_count
+    WHERE id = :request_id
+""")
+
+FAIL_QUERY = text("""
+    UPDATE requests
+    SET status = 'failed', error_message = :error
+    WHERE id = :request_id
+""")
+
+# Crawls are network-bound: fetch all result URLs concurrently and only
+# space out requests that hit the same host
+CRAWL_WORKERS = 16  # Shared by the SEARCH_CONCURRENCY requests in flight
+CRAWL_HOST_DELAY_S = 1.0
+_crawl_executor = ThreadPoolExecutor(max_workers=CRAWL_WORKERS, thread_name_prefix="crawl")
+# host -> monotonic time of its next free fetch slot. Entries outlive any
+# queue of reservations (one per crawl thread), then expire so the map
+# stays bounded however many hosts are crawled.
+_host_next_fetch = TTLCache(maxsize=4096, ttl=CRAWL_HOST_DELAY_S * CRAWL_WORKERS * 2)
+_host_lock = threading.Lock()
+
+# Repeat topics skip the search, and URLs shared across topics skip the
+# crawl. Only non-empty results are cached, so failures are retried.
+# TTLCache isn't thread-safe; handler and crawl threads share _cache_lock.
+_search_cache = TTLCache(maxsize=1024, ttl=settings.SEARCH_CACHE_TTL_S)
+_content_cache = TTLCache(maxsize=4096, ttl=settings.CONTENT_CACHE_TTL_S)
+_cache_lock = threading.Lock()
+# After a page's content expires, it is re-fetched conditionally: url ->
+# (ETag, Last-Modified, content). A 304 reuses the content with no body
+# transfer or extraction.
+_validator_cache = TTLCache(maxsize=4096, ttl=24 * 3600)
+
+# One keep-alive pool for all crawls (trafilatura.fetch_url would otherwise
+# handshake per call). Keeps idle connections for up to 64 hosts, each
+# pool sized for every crawl thread hitting that host
+SESSION = requests.Session()
+_crawl_adapter = HTTPAdapter(
+    pool_connections=64, pool_maxsize=CRAWL_WORKERS * 2,
+    # Retry resets and throttling/gateway errors; a long Retry-After would
+    # stall a crawl thread, so such pages are given up on instead
+    max_retries=Retry(
+        # Jittered exponential backoff so the concurrent crawls retrying one
+        # host don't come back in lockstep
+        total=3, backoff_factor=0.3, backoff_jitter=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False, raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _crawl_adapter)
+SESSION.mount("http://", _crawl_adapter)
+SESSION.headers.update({"User-Agent": "AI-Agent-Search-Worker/1.0"})
+
+# Hosts that return login walls or players instead of article text, and
+# file types trafilatura can't extract; skipped before any fetch
+CRAWL_DENYLIST = {
+    "facebook.com", "instagram.com", "x.com", "twitter.com", "tiktok.com",
+    "youtube.com", "youtu.be", "linkedin.com", "pinterest.com",
+}
+SKIP_EXTENSIONS = (".pdf", ".zip", ".gz", ".mp3", ".mp4", ".avi", ".mov", ".jpg", ".jpeg", ".png", ".gif")
+
+
+def filter_results(search_results):
+    """Drop duplicate (after normalizing), denylisted and non-HTML result URLs"""
+    seen = set()
+    kept = []
+    for result in search_results:
+        parsed = urlparse(result["url"])
+        host = parsed.netloc.lower().removeprefix("www.")
+        path = parsed.path.rstrip("/")
+        key = (host, path, parsed.query)
+        if (
+            key in seen
+            or any(host == denied or host.endswith("." + denied) for denied in CRAWL_DENYLIST)
+            or path.lower().endswith(SKIP_EXTENSIONS)
+        ):
+            logger.info("   ⏭️ Skipping %s", result["url"])
+            continue
+        seen.add(key)
+        kept.append(result)
+    return kept
+
+
+def throttled_fetch(url, headers=None):
+    """GET a URL, starting at least CRAWL_HOST_DELAY_S after the previous fetch from its host"""
+    host = urlparse(url).netloc
+    # Only the slot reservation is locked; the wait and the GET (with its
+    # retries) run unlocked, so a slow host never blocks other fetches
+    with _host_lock:
+        now = time.monotonic()
+        slot = max(now, _host_next_fetch.get(host, 0))
+        _host_next_fetch[host] = slot + CRAWL_HOST_DELAY_S
+    if slot > now:
+        time.sleep(slot - now)
+    # Streamed so read_body can stop at MAX_HTML_BYTES
+    return SESSION.get(url, headers=headers, timeout=10, stream=True)
+
+
+def read_body(response, limit=MAX_HTML_BYTES):
+    """
+    Read at most limit bytes of a streamed body: multi-MB pages (or files
+    served as pages) are never downloaded or held in memory whole.
+    A fully read body returns its connection to the pool; a cut one is closed.
+    """
+    chunks, size = [], 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            response.close()
+            break
+    return b"".join(chunks)[:limit]
+
+
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+
+def get_extract_pool():
+    """
+    Process pool for trafilatura/lxml extraction, which is CPU-bound and
+    mostly holds the GIL. Created once under a lock, since several crawl
+    threads can ask for it at the same time.
+    forkserver: children never fork the worker's Kafka/crawl threads. They
+    do re-import this module (as __mp_main__), which only builds the idle
+    HTTP session, caches and executors; process_search never runs there.
+    """
+    global _extract_pool
+    if _extract_pool is None:
+        with _extract_pool_lock:
+            if _extract_pool is None:
+                _extract_pool = ProcessPoolExecutor(
+                    max_workers=settings.SEARCH_EXTRACT_PROCESSES,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+    return _extract_pool
+
+
+def shutdown_extract_pool():
+    """Stop the extraction processes, if they were started"""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is not None:
+            _extract_pool.shutdown()
+            _extract_pool = None
+
+
+def run_extract(html):
+    """Extract in the process pool, or inline when SEARCH_EXTRACT_PROCESSES=0"""
+    if settings.SEARCH_EXTRACT_PROCESSES <= 0:
+        return extract_text(html)
+    return get_extract_pool().submit(extract_text, html).result()
+
+
+def crawl(url):
+    """Main text for one page, from the content cache or a fresh crawl"""
+    with _cache_lock:
+        content = _content_cache.get(url)
+    if content is not None:
+        logger.info("      ♻️ Cached content for %s", url)
+        return content
+
+    content = extract_page(url)
+    if content:
+        with _cache_lock:
+            _content_cache[url] = content
+    return content
+
+
+def extract_page(url):
+    """Fetch and extract one page's main text ("" when missing or too short)"""
+    with _cache_lock:
+        validated = _validator_cache.get(url)
+    headers = {}
+    if validated:
+        etag, last_modified, _ = validated
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    response = None
+    try:
+        response = throttled_fetch(url, headers)
+        if validated and response.status_code == 304:
+            read_body(response)  # Empty; reading it releases the connection
+            logger.info("      ♻️ Not modified: %s", url)
+            return validated[2]
+        if not response.ok:
+            logger.warning("      ⚠️ Failed to fetch %s", url)
+            return ""
+        body = read_body(response)
+        if not body:
+            logger.warning("      ⚠️ Failed to fetch %s", url)
+            return ""
+        # Text can't be longer than the bytes it came from: bodies this small
+        # (empty pages, redirect stubs) skip the extraction process entirely
+        if len(body) <= MIN_TEXT_CHARS:
+            logger.info("      ⚠️ Content too short (%d bytes): %s", len(body), url)
+            return ""
+
+        text = run_extract(body)
+
+        if text and len(text.strip()) > MIN_TEXT_CHARS:
+            # Allow longer content (up to 8000 chars)
+            content = text.strip()[:8000]
+            logger.info("      ✅ Extracted %d characters from %s", len(content), url)
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            if etag or last_modified:
+                with _cache_lock:
+                    _validator_cache[url] = (etag, last_modified, content)
+            return content
+        logger.info("      ⚠️ Content too short (%d chars): %s", len(text) if text else 0, url)
+    except Exception as e:
+        logger.warning("      ❌ Crawl error for %s: %s", url, e)
+    finally:
+        # Releases (fully read) or drops (cut, failed) the streamed connection
+        if response is not None:
+            response.close()
+    return ""
+
 
 def search_and_crawl(topic, max_results=8):
     """
@@ -13,7 +259,7 @@ def search_and_crawl(topic, max_results=8):
     3. Crawl content (with improved trafilatura settings)
     4. Return results as list (for DB storage)
     """
-    print(f"🔍 Searching for: {topic}")
+    logger.info("🔍 Searching for: %s", topic)
     results = []
 
     # Get configured search engine
@@ -21,148 +267,105 @@ def search_and_crawl(topic, max_results=8):
     
     # 1. Perform search
     try:
-        search_results = search_engine.search(topic, max_results=max_results)
+        # The search itself runs outside the lock
+        with _cache_lock:
+            search_results = _search_cache.get((topic, max_results))
+        if search_results is None:
+            search_results = search_engine.search(topic, max_results=max_results)
+            if search_results:
+                with _cache_lock:
+                    _search_cache[(topic, max_results)] = search_results
+        else:
+            logger.info("   ♻️ Using cached search results")
 
+        search_results = filter_results(search_results)
         for result in search_results:
-            url = result["url"]
-            title = result["title"]
-            print(f"   👉 Found: {title} ({url})")
-
-            # 2. Crawl content (advanced trafilatura settings)
-            try:
-                downloaded = trafilatura.fetch_url(url)
-                content = ""
-                
-                if downloaded:
-                    # Improved extraction settings
-                    text = trafilatura.extract(
-                        downloaded,
-                        include_comments=False,      # Exclude comments
-                        include_tables=True,          # Include tables
-                        no_fallback=False,            # Allow fallback (more content)
-                        favor_precision=False,        # Favor recall (more text)
-                        favor_recall=True,
-                        deduplicate=True,             # Remove duplicates
-                        target_language="ko",         # Prefer Korean
-                    )
-                    
-                    if text and len(text.strip()) > 100:  # Minimum 100 chars
-                        # Allow longer content (up to 8000 chars)
-                        content = text.strip()[:8000]
-                        print(f"      ✅ Extracted {len(content)} characters")
-                    else:
-                        print(f"      ⚠️ Content too short ({len(text) if text else 0} chars)")
-                else:
-                    print(f"      ⚠️ Failed to fetch {url}")
-                    
-            except Exception as e:
-                print(f"      ❌ Crawl error for {url}: {e}")
-                content = ""
+            logger.info("   👉 Found: %s (%s)", result["title"], result["url"])
+
+        # 2. Crawl content concurrently (results keep the search ranking order)
+        contents = _crawl_executor.map(crawl, [result["url"] for result in search_results])
 
-            # Save result (save even if content is empty - title/URL are useful)
+        # Save result (save even if content is empty - title/URL are useful)
+        for result, content in zip(search_results, contents):
             results.append({
-                "url": url,
-                "title": title,
+                "url": result["url"],
+                "title": result["title"],
                 "content": content
             })
 
-            time.sleep(1)  # Prevent blocking
-
     except Exception as e:
-        print(f"❌ Search Error: {e}")
+        logger.exception("❌ Search Error: %s", e)
 
     # Return only results with valid content
     valid_results = [r for r in results if r["content"]]
-    print(f"📊 Total: {len(results)} results, Valid: {len(valid_results)} with content")
+    logger.info("📊 Total: %d results, Valid: %d with content", len(results), len(valid_results))
     
     return valid_results if valid_results else results[:3]  # Return at least 3
 
 
-def process_search():
-    consumer = KafkaConsumerWrapper(
-        topic=settings.KAFKA_TOPIC_SEARCH, group_id=settings.KAFKA_GROUP_SEARCH
-    )
-    producer = KafkaProducerWrapper()
-
-    # Show which search engine is being used
-    engine_name = settings.SEARCH_ENGINE.upper()
-    if settings.SEARCH_ENGINE.lower() == "searxng" and settings.SEARXNG_URL:
-        print(f"🚀 [Search Worker] Ready using SearXNG ({settings.SEARXNG_URL})...")
-    else:
-        print(f"🚀 [Search Worker] Ready using DuckDuckGo...")
+def handle_request(task, producer):
+    """Claim one search task, search + crawl, store the results and hand off to the AI worker"""
+    request_id = task.get("request_id")
+    topic = task.get("topic")
+    logger.info("📨 Received request: %s : %s", request_id, topic)
 
-    for message in consumer.get_messages():
-        db = SessionLocal()
+    # Own session per task: tasks from one batch run in parallel threads
+    with SessionLocal() as db:
         try:
-            task = message.value
-            request_id = task.get("request_id")
-            topic = task.get("topic")
-
-            print(f"\n{'='*60}")
-            print(f"Received request: {request_id} : {topic}")
-
-            # 🔒 Pessimistic Lock: Row-level locking
-            # SELECT FOR UPDATE SKIP LOCKED prevents race conditions
-            from sqlalchemy import text
-            
-            # Try to acquire exclusive lock on this request
-            lock_query = text("""
-                SELECT id, status 
-                FROM requests 
-                WHERE id = :request_id 
-                AND status = 'searching'
-                FOR UPDATE SKIP LOCKED
-            """)
-            
-            result = db.execute(lock_query, {"request_id": request_id}).fetchone()
-            
-            if not result:
-                # Either already locked by another worker, or status != 'searching'
-                existing = db.query(Request).filter(Request.id == request_id).first()
-                if existing:
-                    if existing.status == 'searching':
-                        print(f"🔒 Request {request_id} locked by another worker, skipping")
+            # 🔒 Claim: lock + status flip in one round-trip.
+            # SKIP LOCKED makes a concurrently held row return nothing
+            claimed = db.execute(CLAIM_QUERY, {"request_id": request_id}).fetchone()
+
+            if not claimed:
+                # Diagnostics only (skip path)
+                status = db.execute(
+                    select(Request.status).where(Request.id == request_id)
+                ).scalar_one_or_none()
+                if status:
+                    if status == 'searching':
+                        logger.info("🔒 Request %s locked by another worker, skipping", request_id)
                     else:
-                        print(f"⏭️  Request {request_id} already processed (status: {existing.status})")
+                        logger.info("⏭️  Request %s already processed (status: %s)", request_id, status)
                 else:
-                    print(f"❌ Request {request_id} not found")
-                consumer.consumer.commit()
-                continue
+                    logger.warning("❌ Request %s not found", request_id)
+                return
 
-            # We successfully acquired the lock! Update status immediately
-            db_request = db.query(Request).filter(Request.id == request_id).first()
-            db_request.status = 'processing_search'
             db.commit()
-            print(f"✅ Locked and claimed request {request_id}")
+            topic = claimed.topic
+            logger.info("✅ Locked and claimed request %s", request_id)
 
             # Perform search
-            search_results_data = search_and_crawl(topic, max_results=8)
+            search_results_data = search_and_crawl(topic, max_results=settings.SEARCH_MAX_RESULTS)
 
             if not search_results_data:
-                print(f"⚠️  No search results for {topic}")
+                logger.warning("⚠️  No search results for %s", topic)
                 # Update status to failed
-                db_request.status = "failed"
-                db_request.error_message = "No search results found"
+                db.execute(FAIL_QUERY, {"request_id": request_id, "error": "No search results found"})
                 db.commit()
-                consumer.consumer.commit()
-                continue
+                return
 
-            # Save search results to DB
-            for result_data in search_results_data:
-                search_result = SearchResult(
-                    request_id=request_id,
-                    url=result_data['url'],
-                    title=result_data['title'],
-                    content=result_data['content']
-                )
-                db.add(search_result)
-            
-            db.commit()
-            print(f"💾 Saved {len(search_results_data)} search results to DB")
+            # Save search results to DB: one executemany (batched into
+            # multi-row INSERTs by insertmanyvalues) instead of a unit-of-work
+            # flush of one ORM object per row
+            db.execute(insert(SearchResult), [
+                {
+                    "request_id": request_id,
+                    "url": result_data['url'],
+                    "title": result_data['title'],
+                    "content": result_data['content'],
+                }
+                for result_data in search_results_data
+            ])
 
-            # Update request status: processing_search → analyzing
-            db_request.status = "analyzing"
+            # Update request status: processing_search → analyzing, with the
+            # result count (same transaction as the results, so the AI worker
+            # never sees 'analyzing' without them)
+            db.execute(ANALYZING_QUERY, {
+                "request_id": request_id,
+                "search_results_count": len(search_results_data),
+            })
             db.commit()
+            logger.info("💾 Saved %d search results to DB", len(search_results_data))
 
             # Send analysis request to AI Worker
             producer.send_data(
@@ -172,22 +375,46 @@ def process_search():
                     "topic": topic
                 }
             )
-            
-            # Commit Kafka offset
-            consumer.consumer.commit()
-            print(f"✅ Request {request_id} handed off to AI worker")
+            logger.info("✅ Request %s handed off to AI worker", request_id)
 
         except Exception as e:
-            print(f"❌ Worker Error: {e}")
+            logger.exception("❌ Worker Error: %s", e)
+            # Discard the failed transaction before writing the error status
+            db.rollback()
             # Save error status
-            if 'request_id' in locals() and request_id:
-                db_request = db.query(Request).filter(Request.id == request_id).first()
-                if db_request:
-                    db_request.status = "failed"
-                    db_request.error_message = str(e)
-                    db.commit()
-        finally:
-            db.close()
+            if request_id:
+                db.execute(FAIL_QUERY, {"request_id": request_id, "error": str(e)})
+                db.commit()
+
+
+def process_search():
+    # Each message is a full search + crawl, so fetch only a batch of
+    # SEARCH_CONCURRENCY at a time to stay inside max_poll_interval_ms
+    consumer = KafkaConsumerWrapper(
+        topic=settings.KAFKA_TOPIC_SEARCH, group_id=settings.KAFKA_GROUP_SEARCH,
+        max_poll_records=settings.SEARCH_CONCURRENCY,
+    )
+    producer = KafkaProducerWrapper()
+
+    # Show which search engine is being used
+    if settings.SEARCH_ENGINE.lower() == "searxng" and settings.SEARXNG_URL:
+        logger.info("🚀 [Search Worker] Ready using SearXNG (%s)...", settings.SEARXNG_URL)
+    else:
+        logger.info("🚀 [Search Worker] Ready using DuckDuckGo...")
+
+    # The tasks of one poll are handled in parallel (their searches, crawls
+    # and DB writes overlap); offsets are committed once the whole batch is
+    # done, asynchronously so the next poll doesn't wait for the broker
+    with ThreadPoolExecutor(
+        max_workers=settings.SEARCH_CONCURRENCY, thread_name_prefix="search"
+    ) as executor:
+        for batch in consumer.get_batches(max_records=settings.SEARCH_CONCURRENCY, timeout_ms=500):
+            if not batch:
+                continue
+            list(executor.map(lambda message: handle_request(message.value, producer), batch))
+            consumer.commit_offsets(batch, asynchronous=True)
+
+    shutdown_extract_pool()
 
 
 if __name__ == "__main__":
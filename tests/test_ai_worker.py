@@ -11,9 +11,33 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 # Import functions to test (safe - no heavy dependencies like vLLM)
-from common.ai_worker_utils import get_gpu_memory_gb, select_model_by_vram
+from common.ai_worker_utils import (
+    get_gpu_memory_gb,
+    get_gpu_compute_capability,
+    supports_fp8,
+    select_model_by_vram,
+    CONTEXT_SEPARATOR,
+    format_search_result,
+    rank_sentences,
+    adaptive_max_tokens,
+    infer_quantization,
+    get_rope_scaling,
+    pack_chunks,
+)
 
 
+@pytest.fixture
+def nvidia_smi_only():
+    """Hide pynvml (so the nvidia-smi path runs) and reset the detection caches."""
+    get_gpu_memory_gb.cache_clear()
+    get_gpu_compute_capability.cache_clear()
+    with patch.dict('sys.modules', {'pynvml': None}):
+        yield
+    get_gpu_memory_gb.cache_clear()
+    get_gpu_compute_capability.cache_clear()
+
+
+@pytest.mark.usefixtures("nvidia_smi_only")
 class TestGetGpuMemoryGb:
     """Tests for GPU memory detection function."""
     
@@ -49,6 +73,33 @@ class TestGetGpuMemoryGb:
                 result = get_gpu_memory_gb()
                 assert result is None
 
+    def test_result_is_cached(self):
+        """Test detection runs once per process."""
+        with patch('subprocess.run') as mock_run:
+            mock_run.return_value = MagicMock(returncode=0, stdout="12288\n")
+
+            assert get_gpu_memory_gb() == get_gpu_memory_gb() == 12.0
+            mock_run.assert_called_once()
+
+
+@pytest.mark.usefixtures("nvidia_smi_only")
+class TestGetGpuComputeCapability:
+    """Tests for GPU compute capability detection."""
+
+    def test_nvidia_smi_ada(self):
+        """Test compute capability parsing for RTX 40xx."""
+        with patch('subprocess.run') as mock_run:
+            mock_run.return_value = MagicMock(returncode=0, stdout="8.9\n")
+
+            assert get_gpu_compute_capability() == 8.9
+
+    def test_supports_fp8(self):
+        """Test FP8 support starts at Ada Lovelace (8.9)."""
+        assert supports_fp8(8.9)
+        assert supports_fp8(9.0)
+        assert not supports_fp8(8.6)  # RTX 30xx
+        assert not supports_fp8(None)
+
 
 class TestSelectModelByVram:
     """Tests for model selection based on VRAM."""
@@ -102,8 +153,181 @@ class TestSelectModelByVram:
         model, _, _ = select_model_by_vram(20.0)
         assert "70B" in model
     
+    def test_16gb_selects_8b_32k_context(self):
+        """Test 16GB GPUs get the 8B model with a 32k context."""
+        model, quant, max_len = select_model_by_vram(16.0)
+
+        assert "8B" in model
+        assert quant == "awq"
+        assert max_len == 32768
+
     def test_boundary_10gb(self):
         """Test 10GB boundary selects 8B with full context."""
         model, _, max_len = select_model_by_vram(10.0)
         assert "8B" in model
         assert max_len == 8192
+
+    def test_16gb_fp8_selects_fp8_checkpoint(self):
+        """Test FP8-capable 16GB GPUs get the FP8 W8A8 model."""
+        model, quant, max_len = select_model_by_vram(16.0, fp8_supported=True)
+
+        assert "FP8" in model
+        assert quant == "fp8"
+        assert max_len == 32768
+
+    def test_12gb_fp8_keeps_awq(self):
+        """Test VRAM-bound 12GB GPUs stay on AWQ even with FP8 support."""
+        _, quant, _ = select_model_by_vram(12.0, fp8_supported=True)
+        assert quant == "awq"
+
+
+class TestFormatSearchResult:
+    """Tests for LLM context formatting."""
+
+    def test_format_search_result(self, sample_search_results):
+        """Test a search result is formatted as a numbered context item."""
+        item = format_search_result(1, sample_search_results[0])
+
+        assert item == (
+            "[결과 1]\n"
+            "제목: Test Article 1\n"
+            "URL: https://example.com/article1\n"
+            "내용: This is test content for article 1.\n"
+        )
+
+    def test_format_search_result_caps_content(self):
+        """Test content is truncated to the hard cap."""
+        result = {"title": "T", "url": "https://example.com", "content": "A" * 50}
+        item = format_search_result(2, result, max_content_chars=10)
+
+        assert "내용: " + "A" * 10 + "\n" in item
+
+    def test_format_search_result_empty_content(self):
+        """Test missing content does not break formatting."""
+        result = {"title": "T", "url": "https://example.com", "content": None}
+        assert format_search_result(1, result).endswith("내용: \n")
+
+    def test_context_join(self, sample_search_results):
+        """Test items are joined with the context separator."""
+        items = [format_search_result(i, r) for i, r in enumerate(sample_search_results, 1)]
+        context = CONTEXT_SEPARATOR.join(items)
+
+        assert context.count("[결과") == 2
+        assert "\n---\n[결과 2]" in context
+
+
+class TestRankSentences:
+    """Tests for BM25-based content compression."""
+
+    def test_short_content_unchanged(self):
+        """Test content within budget is returned as-is."""
+        assert rank_sentences("Short text.", "topic", max_chars=100) == "Short text."
+
+    def test_keeps_relevant_sentences(self):
+        """Test relevant sentences are kept and irrelevant ones dropped."""
+        content = (
+            "Cookies are used on this site. "
+            "Electric vehicles use lithium batteries. "
+            "Subscribe to our newsletter today. "
+            "Battery prices for electric vehicles keep falling."
+        )
+        result = rank_sentences(content, "electric vehicle battery", max_chars=100)
+
+        assert "lithium batteries" in result
+        assert "keep falling" in result
+        assert "newsletter" not in result
+        assert len(result) <= 100
+
+    def test_preserves_original_order(self):
+        """Test kept sentences stay in document order."""
+        content = "Alpha topic one. Filler text here. Beta topic two."
+        result = rank_sentences(content, "topic", max_chars=35)
+
+        assert result.index("Alpha") < result.index("Beta")
+
+    def test_korean_particles_match(self):
+        """Test Korean words with particles still match the topic."""
+        content = "오늘 날씨는 맑습니다. 인공지능의 발전이 빠릅니다. 점심 메뉴를 골랐습니다."
+        result = rank_sentences(content, "인공지능", max_chars=20)
+
+        assert "인공지능의" in result
+
+    def test_no_match_falls_back_to_prefix(self):
+        """Test content is truncated when no sentence matches the topic."""
+        result = rank_sentences("Some words. " * 20, "unrelated", max_chars=30)
+
+        assert result == ("Some words. " * 20)[:30]
+
+    def test_no_sentences_falls_back_to_prefix(self):
+        """Test whitespace-only content is truncated instead of dividing by zero."""
+        assert rank_sentences(" " * 50, "quantum", max_chars=10) == " " * 10
+
+
+class TestAdaptiveMaxTokens:
+    """Tests for prompt-scaled decode budget."""
+
+    def test_short_prompt_gets_base_budget(self):
+        """Test a short prompt gets roughly the base budget."""
+        assert adaptive_max_tokens(100) == 512 + 12
+
+    def test_budget_grows_with_prompt(self):
+        """Test longer prompts get a larger budget."""
+        assert adaptive_max_tokens(4000) == 1012
+
+    def test_budget_is_capped(self):
+        """Test the budget never exceeds the cap."""
+        assert adaptive_max_tokens(100000) == 1536
+        assert adaptive_max_tokens(100000, cap=1024) == 1024
+
+
+class TestInferQuantization:
+    """Tests for quantization detection from checkpoint names."""
+
+    def test_awq_checkpoint(self):
+        """Test AWQ checkpoints are detected."""
+        assert infer_quantization("hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4") == "awq"
+
+    def test_fp8_checkpoint(self):
+        """Test FP8 checkpoints are detected."""
+        assert infer_quantization("neuralmagic/Meta-Llama-3.1-8B-Instruct-FP8") == "fp8"
+
+    def test_unquantized_checkpoint(self):
+        """Test full-precision checkpoints return None."""
+        assert infer_quantization("Qwen/Qwen2.5-7B-Instruct") is None
+
+
+class TestGetRopeScaling:
+    """Tests for the RoPE scaling override."""
+
+    def test_llama31_gets_llama3_rope(self):
+        """Test Llama 3.1 checkpoints get the llama3 rope_scaling config."""
+        rope = get_rope_scaling("hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4")
+
+        assert rope["rope_type"] == "llama3"
+        assert rope["factor"] == 8.0
+        assert rope["original_max_position_embeddings"] == 8192
+
+    def test_other_models_keep_own_config(self):
+        """Test other models are left untouched."""
+        assert get_rope_scaling("Qwen/Qwen2.5-7B-Instruct-AWQ") is None
+
+
+class TestPackChunks:
+    """Tests for Map-phase token packing."""
+
+    def test_packs_items_up_to_budget(self):
+        """Test consecutive items share a chunk while they fit."""
+        assert pack_chunks([40, 40, 40, 40], max_tokens=100) == [[0, 1], [2, 3]]
+
+    def test_separator_tokens_are_counted(self):
+        """Test separators between items count against the budget."""
+        assert pack_chunks([50, 50], max_tokens=100, sep_len=0) == [[0, 1]]
+        assert pack_chunks([50, 50], max_tokens=100, sep_len=3) == [[0], [1]]
+
+    def test_oversize_item_gets_own_chunk(self):
+        """Test an item larger than the budget is never merged."""
+        assert pack_chunks([10, 500, 10], max_tokens=100) == [[0], [1], [2]]
+
+    def test_empty_input(self):
+        """Test no items yields no chunks."""
+        assert pack_chunks([], max_tokens=100) == []
@@ -113,3 +113,329 @@ class TestKafkaIntegration:
             producer.send_data(topic="test-topic", value={"key": "value"})
             
             mock_producer_instance.send.assert_called_once()
+
+
+class TestStreamEvents:
+    """Tests for Server-Sent Events formatting."""
+
+    def test_sse_event_format(self, mock_infrastructure):
+        """Test events have an event line, a JSON data line and a blank line."""
+        from api_server.main import sse_event
+
+        message = sse_event("partial", {"status": "processing_analysis", "partial_summary": "요약"})
+
+        assert message.startswith("event: partial\ndata: ")
+        assert message.endswith("\n\n")
+        assert '"partial_summary":"요약"' in message
+
+    def test_sse_event_encodes_datetimes(self, mock_infrastructure):
+        """Test payloads are encoded like the other responses (orjson)."""
+        from api_server.main import sse_event
+
+        message = sse_event("done", {"completed_at": datetime(2024, 5, 1, 12, 30)})
+
+        assert '"completed_at":"2024-05-01T12:30:00"' in message
+
+
+class TestRequestUpdates:
+    """Tests for the LISTEN/NOTIFY fan-out behind /stream/{id}."""
+
+    def test_notify_wakes_only_matching_subscribers(self, mock_infrastructure):
+        """Test a NOTIFY payload sets the events subscribed to that request id."""
+        import asyncio
+        from api_server.main import RequestUpdates
+
+        async def run():
+            updates = RequestUpdates()
+            request_id, other_id = uuid4(), uuid4()
+            event = updates.subscribe(request_id)
+            other = updates.subscribe(other_id)
+
+            updates._on_notify(None, 1, RequestUpdates.CHANNEL, str(request_id))
+
+            assert event.is_set()
+            assert not other.is_set()
+
+            updates.unsubscribe(request_id, event)
+            assert str(request_id) not in updates._waiters
+
+        asyncio.run(run())
+
+    def test_wait_for_update_polls_without_listener(self, mock_infrastructure):
+        """Test streams fall back to the poll interval when LISTEN is down."""
+        import asyncio
+        from unittest.mock import AsyncMock
+        import api_server.main as api_main
+
+        async def run():
+            with patch.object(api_main.asyncio, "sleep", new_callable=AsyncMock) as mock_sleep:
+                await api_main.wait_for_update(asyncio.Event())
+            mock_sleep.assert_awaited_once_with(api_main.settings.STREAM_POLL_INTERVAL_S)
+
+        assert not api_main.request_updates.connected
+        asyncio.run(run())
+
+
+class TestAsyncDatabase:
+    """Tests for the API server's async session factory."""
+
+    def test_async_sessionmaker_uses_asyncpg(self, mock_infrastructure):
+        """Test the async engine reuses DATABASE_URL with the asyncpg driver."""
+        from common.database import get_async_sessionmaker
+
+        session_factory = get_async_sessionmaker()
+
+        assert session_factory.kw["bind"].url.drivername == "postgresql+asyncpg"
+        assert session_factory.kw["expire_on_commit"] is False
+        assert get_async_sessionmaker() is session_factory
+
+    def test_migrate_schema_skips_up_to_date_indexes(self, mock_infrastructure):
+        """Test migrations run under the advisory lock and only rebuild stale indexes."""
+        import asyncio
+        from unittest.mock import AsyncMock
+        from common.database import SCHEMA_MIGRATIONS, INDEX_STATE_QUERY, migrate_schema
+
+        index_state = {
+            "idx_requests_status_created_at": MagicMock(
+                indisvalid=True,
+                indexdef="CREATE INDEX idx_requests_status_created_at ON public.requests "
+                         "USING btree (status, created_at DESC, id DESC)",
+            ),
+            # Pre-tiebreaker definition from an older init.sql
+            "idx_requests_created_at": MagicMock(
+                indisvalid=True,
+                indexdef="CREATE INDEX idx_requests_created_at ON public.requests "
+                         "USING btree (created_at DESC)",
+            ),
+        }
+
+        async def execute(statement, params=None):
+            result = MagicMock()
+            if statement is INDEX_STATE_QUERY:
+                result.first.return_value = index_state[params["name"]]
+            return result
+
+        conn = MagicMock()
+        conn.execute = AsyncMock(side_effect=execute)
+        conn.execution_options = AsyncMock(return_value=conn)
+        engine = MagicMock()
+        engine.connect.return_value.__aenter__ = AsyncMock(return_value=conn)
+        engine.connect.return_value.__aexit__ = AsyncMock(return_value=False)
+
+        asyncio.run(migrate_schema(engine))
+
+        conn.execution_options.assert_awaited_once_with(isolation_level="AUTOCOMMIT")
+        statements = [call.args[0].text for call in conn.execute.call_args_list]
+        assert "pg_advisory_lock" in statements[0]
+        assert "pg_advisory_unlock" in statements[-1]
+        assert statements[1:1 + len(SCHEMA_MIGRATIONS)] == list(SCHEMA_MIGRATIONS)
+        ddl = [sql for sql in statements if sql.startswith(("CREATE INDEX", "DROP INDEX"))]
+        assert ddl == [
+            "DROP INDEX CONCURRENTLY idx_requests_created_at",
+            "CREATE INDEX CONCURRENTLY idx_requests_created_at ON requests(created_at DESC, id DESC)",
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_requests_status",
+        ]
+
+    def test_pool_is_bounded(self, mock_infrastructure):
+        """Test the pool sizing formula caps connections and disables overflow."""
+        from common.database import POOL_OPTIONS
+
+        assert 2 <= POOL_OPTIONS["pool_size"] <= 20
+        assert POOL_OPTIONS["max_overflow"] == 0
+
+    def test_request_relationships_never_lazy_load(self):
+        """Test unloaded Request relationships raise instead of issuing N+1 SELECTs."""
+        from common.database import Request
+
+        assert Request.search_results.property.lazy == "raise_on_sql"
+        assert Request.analysis_result.property.lazy == "raise_on_sql"
+
+
+class TestKeysetCursor:
+    """Tests for /api/requests keyset pagination cursors."""
+
+    def test_cursor_round_trip(self, mock_infrastructure):
+        """Test a cursor decodes back to the row's (created_at, id)."""
+        from api_server.main import encode_cursor, decode_cursor
+
+        created_at, request_id = datetime(2024, 5, 1, 12, 30, 0, 123456), uuid4()
+
+        assert decode_cursor(encode_cursor(created_at, request_id)) == (created_at, request_id)
+
+    def test_invalid_cursor_is_bad_request(self, mock_infrastructure):
+        """Test malformed cursors are rejected with HTTP 400."""
+        from fastapi import HTTPException
+        from api_server.main import decode_cursor
+
+        with pytest.raises(HTTPException) as exc_info:
+            decode_cursor("not-a-cursor")
+        assert exc_info.value.status_code == 400
+
+    @pytest.mark.parametrize("query", ["limit=0", "limit=-1", "offset=-1"])
+    def test_out_of_range_paging_is_rejected(self, mock_infrastructure, query):
+        """Test non-positive limits and negative offsets get a 422, not a 500."""
+        from fastapi.testclient import TestClient
+        import api_server.main as api_main
+
+        api_main.app.dependency_overrides[api_main.get_db] = lambda: MagicMock()
+        try:
+            response = TestClient(api_main.app).get(f"/api/requests?{query}")
+        finally:
+            api_main.app.dependency_overrides.clear()
+
+        assert response.status_code == 422
+
+
+class TestMetricsCache:
+    """Tests for the /api/metrics cache."""
+
+    def test_concurrent_polls_share_one_computation(self, mock_infrastructure):
+        """Test concurrent metrics requests within the TTL compute only once."""
+        import asyncio
+        from fastapi import Response
+        import api_server.main as api_main
+
+        calls = []
+
+        async def fake_compute(db):
+            calls.append(db)
+            await asyncio.sleep(0)
+            return {"total_requests": 1}
+
+        async def poll_concurrently():
+            return await asyncio.gather(
+                *(api_main.get_metrics(Response(), db=None) for _ in range(5))
+            )
+
+        with patch.object(api_main, "_metrics", None), \
+                patch.object(api_main, "compute_metrics", fake_compute):
+            results = asyncio.run(poll_concurrently())
+
+        assert len(calls) == 1
+        assert all(result == {"total_requests": 1} for result in results)
+
+    def test_stale_metrics_served_while_refreshing(self, mock_infrastructure):
+        """Test an expired value is returned at once and refreshed once in the background."""
+        import asyncio
+        import time
+        from unittest.mock import AsyncMock
+        from fastapi import Response
+        import api_server.main as api_main
+
+        compute = AsyncMock(return_value={"total_requests": 2})
+        session = MagicMock()
+        session.return_value.__aenter__ = AsyncMock(return_value=MagicMock())
+        session.return_value.__aexit__ = AsyncMock(return_value=False)
+        stale_at = time.monotonic() - api_main.settings.METRICS_CACHE_TTL_S - 1
+
+        async def poll_then_wait():
+            results = await asyncio.gather(
+                *(api_main.get_metrics(Response(), db=None) for _ in range(3))
+            )
+            await api_main._metrics_refresh
+            return results
+
+        with patch.object(api_main, "_metrics", (stale_at, {"total_requests": 1})), \
+                patch.object(api_main, "_metrics_refresh", None), \
+                patch.object(api_main, "compute_metrics", compute), \
+                patch.object(api_main, "get_async_sessionmaker", return_value=session):
+            results = asyncio.run(poll_then_wait())
+            refreshed = api_main._metrics[1]
+
+        assert all(result == {"total_requests": 1} for result in results)
+        compute.assert_awaited_once()
+        assert refreshed == {"total_requests": 2}
+
+
+class TestAnalyzeHandler:
+    """Tests for the /analyze handler flow."""
+
+    def test_search_task_published_in_background(self, mock_infrastructure):
+        """Test the Kafka send is deferred to a background task after commit."""
+        import asyncio
+        from unittest.mock import AsyncMock
+        from fastapi import BackgroundTasks
+        import api_server.main as api_main
+
+        request_id = uuid4()
+        db = MagicMock()
+        db.execute = AsyncMock(return_value=MagicMock(scalar_one=MagicMock(return_value=request_id)))
+        db.commit = AsyncMock()
+        background_tasks = BackgroundTasks()
+
+        with patch.object(api_main, "get_producer") as mock_get_producer:
+            result = asyncio.run(api_main.analyze(
+                api_main.AnalyzeRequest(topic="test topic"), background_tasks, db=db
+            ))
+            mock_get_producer.assert_not_called()
+
+            db.commit.assert_awaited_once()
+            assert result["request_id"] == str(request_id)
+            assert len(background_tasks.tasks) == 1
+
+            asyncio.run(background_tasks())
+            mock_get_producer.return_value.send_data.assert_called_once_with(
+                topic="search-queue",
+                value={"request_id": str(request_id), "topic": "test topic"},
+                key=api_main.message_key("test topic"),
+            )
+
+    @pytest.mark.parametrize("failure", [
+        {"send": Exception("KafkaTimeoutError")},
+        {"connect": "ProducerUnavailable"},
+    ])
+    def test_publish_failure_marks_request_failed(self, mock_infrastructure, failure):
+        """Test a failed connect or send marks the row failed instead of raising."""
+        import asyncio
+        from unittest.mock import AsyncMock
+        import api_server.main as api_main
+
+        request_id = str(uuid4())
+        db = MagicMock()
+        db.execute = AsyncMock()
+        db.commit = AsyncMock()
+        session = MagicMock()
+        session.return_value.__aenter__ = AsyncMock(return_value=db)
+        session.return_value.__aexit__ = AsyncMock(return_value=False)
+
+        with patch.object(api_main, "get_producer") as mock_get_producer, \
+                patch.object(api_main, "get_async_sessionmaker", return_value=session):
+            if "connect" in failure:
+                mock_get_producer.side_effect = getattr(api_main, failure["connect"])("Kafka unavailable")
+            else:
+                mock_get_producer.return_value.send_data.return_value.get.side_effect = failure["send"]
+            asyncio.run(api_main.publish_search_task(request_id, "test topic"))
+
+        db.execute.assert_awaited_once()
+        params = db.execute.call_args.args[0].compile().params
+        assert params["status"] == "failed"
+        assert params["error_message"]
+        db.commit.assert_awaited_once()
+
+    def test_producer_created_lazily_once(self, mock_infrastructure):
+        """Test importing the app doesn't connect to Kafka; get_producer does, once."""
+        import api_server.main as api_main
+
+        with patch.object(api_main, "producer", None), \
+                patch.object(api_main, "KafkaProducerWrapper") as mock_wrapper:
+            first = api_main.get_producer()
+            second = api_main.get_producer()
+
+        mock_wrapper.assert_called_once()
+        assert first is second
+
+    def test_producer_connect_failure_is_bounded(self, mock_infrastructure):
+        """Test a failed connect raises quickly and isn't retried within the cooldown."""
+        import api_server.main as api_main
+
+        with patch.object(api_main, "producer", None), \
+                patch.object(api_main, "_producer_failed_at", None), \
+                patch.object(api_main, "KafkaProducerWrapper",
+                             side_effect=ConnectionError("no brokers")) as mock_wrapper:
+            for _ in range(2):
+                with pytest.raises(api_main.ProducerUnavailable):
+                    api_main.get_producer()
+
+        mock_wrapper.assert_called_once()
+        assert mock_wrapper.call_args.kwargs["exit_on_failure"] is False
+        assert mock_wrapper.call_args.kwargs["max_retries"] == api_main.PRODUCER_CONNECT_RETRIES
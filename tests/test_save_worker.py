@@ -0,0 +1,108 @@
+"""
+Unit tests for the legacy Save Worker.
+"""
+import pytest
+from unittest.mock import patch, MagicMock
+import importlib
+import sys
+import os
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+@pytest.fixture
+def save_main():
+    """Import save_worker.main with boto3/botocore stubbed (not installed in tests)."""
+    stubs = {
+        'boto3': MagicMock(),
+        'boto3.s3': MagicMock(),
+        'boto3.s3.transfer': MagicMock(),
+        'botocore': MagicMock(),
+        'botocore.client': MagicMock(),
+    }
+    with patch.dict('sys.modules', stubs):
+        sys.modules.pop('save_worker.main', None)
+        module = importlib.import_module('save_worker.main')
+        yield module
+    sys.modules.pop('save_worker.main', None)
+
+
+class TestSaveMessage:
+    """Tests for the single PUT / multipart upload split."""
+
+    def test_small_body_uses_put_object(self, save_main):
+        """Test bodies under the threshold go up as one put_object."""
+        s3 = MagicMock()
+
+        file_name = save_main.save_message(s3, {"url": "https://example.com", "text": "hi"})
+
+        s3.put_object.assert_called_once()
+        s3.upload_fileobj.assert_not_called()
+        kwargs = s3.put_object.call_args.kwargs
+        assert kwargs["Key"] == file_name
+        assert kwargs["Bucket"] == save_main.settings.MINIO_BUCKET_NAME
+        assert kwargs["Body"] == b'{"url":"https://example.com","text":"hi"}'
+        assert file_name.endswith(".json")
+
+    def test_large_body_uses_upload_fileobj(self, save_main):
+        """Test bodies at or over the threshold use the multipart transfer."""
+        s3 = MagicMock()
+
+        with patch.object(save_main, 'MULTIPART_THRESHOLD', 16):
+            file_name = save_main.save_message(s3, {"text": "x" * 64})
+
+        s3.put_object.assert_not_called()
+        s3.upload_fileobj.assert_called_once()
+        args, kwargs = s3.upload_fileobj.call_args
+        assert args[0].getvalue() == b'{"text":"' + b"x" * 64 + b'"}'
+        assert args[1:] == (save_main.settings.MINIO_BUCKET_NAME, file_name)
+        assert kwargs["Config"] is save_main.TRANSFER_CONFIG
+        assert kwargs["ExtraArgs"] == {"ContentType": "application/json"}
+
+
+class TestFinishBatch:
+    """Tests for committing a batch only past successful saves."""
+
+    @staticmethod
+    def make_message(partition, offset):
+        message = MagicMock(topic="topic_raw", partition=partition, offset=offset)
+        message.value = {"url": f"https://example.com/{partition}/{offset}"}
+        return message
+
+    @staticmethod
+    def make_future(error=None):
+        from concurrent.futures import Future
+
+        future = Future()
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result("file.json")
+        return future
+
+    def test_all_saved_commits_whole_batch(self, save_main):
+        """Test a fully saved batch commits every message."""
+        consumer = MagicMock()
+        batch = [self.make_message(0, 1), self.make_message(0, 2)]
+        futures = {self.make_future(): message for message in batch}
+
+        save_main.finish_batch(consumer, batch, futures)
+
+        consumer.commit_offsets.assert_called_once_with(batch, asynchronous=True)
+
+    def test_failed_save_stops_at_first_failure_per_partition(self, save_main):
+        """Test offsets stop before the first failed PUT on its partition, then the saver stops."""
+        consumer = MagicMock()
+        batch = [
+            self.make_message(0, 1), self.make_message(0, 2), self.make_message(0, 3),
+            self.make_message(1, 5),
+        ]
+        errors = [None, ConnectionError("MinIO down"), None, None]
+        futures = {self.make_future(error): message for error, message in zip(errors, batch)}
+
+        with pytest.raises(RuntimeError):
+            save_main.finish_batch(consumer, batch, futures)
+
+        committed = consumer.commit_offsets.call_args.args[0]
+        assert [(m.partition, m.offset) for m in committed] == [(0, 1), (1, 5)]
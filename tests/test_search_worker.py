@@ -18,8 +18,7 @@ class TestSearchEngine:
         from common.search_engine import DuckDuckGoSearch
         
         with patch('duckduckgo_search.DDGS') as mock_ddgs:
-            mock_instance = MagicMock()
-            mock_ddgs.return_value.__enter__.return_value = mock_instance
+            mock_instance = mock_ddgs.return_value
             mock_instance.text.return_value = [
                 {"href": "https://example.com", "title": "Example", "body": "Description"},
             ]
@@ -36,8 +35,7 @@ class TestSearchEngine:
         from common.search_engine import DuckDuckGoSearch
         
         with patch('duckduckgo_search.DDGS') as mock_ddgs:
-            mock_instance = MagicMock()
-            mock_ddgs.return_value.__enter__.return_value = mock_instance
+            mock_instance = mock_ddgs.return_value
             mock_instance.text.return_value = []
             
             engine = DuckDuckGoSearch()
@@ -49,7 +47,7 @@ class TestSearchEngine:
         """Test SearXNG search returns results."""
         from common.search_engine import SearXNGSearch
         
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_response = MagicMock()
             mock_response.json.return_value = {
                 "results": [
@@ -76,6 +74,29 @@ class TestSearchEngine:
             engine = get_search_engine()
             assert isinstance(engine, DuckDuckGoSearch)
     
+    def test_get_search_engine_reuses_instance(self):
+        """Test repeated calls with the same settings share one engine."""
+        from common.search_engine import get_search_engine
+
+        with patch('common.search_engine.settings') as mock_settings:
+            mock_settings.SEARCH_ENGINE = "searxng"
+            mock_settings.SEARXNG_URL = "http://localhost:8080"
+
+            assert get_search_engine() is get_search_engine()
+
+    def test_duckduckgo_reuses_client(self):
+        """Test one DDGS client serves consecutive searches."""
+        from common.search_engine import DuckDuckGoSearch
+
+        with patch('duckduckgo_search.DDGS') as mock_ddgs:
+            mock_ddgs.return_value.text.return_value = []
+
+            engine = DuckDuckGoSearch()
+            engine.search("first", max_results=1)
+            engine.search("second", max_results=1)
+
+            mock_ddgs.assert_called_once()
+
     def test_get_search_engine_searxng(self):
         """Test SearXNG engine selection."""
         from common.search_engine import get_search_engine, SearXNGSearch
@@ -104,16 +125,148 @@ class TestSearchAndCrawl:
                         ]
                         mock_engine.return_value = mock_search
                         
-                        with patch('trafilatura.fetch_url') as mock_fetch:
-                            mock_fetch.return_value = "<html><body>Content</body></html>"
+                        with patch('requests.Session.get') as mock_fetch:
+                            mock_fetch.return_value.ok = True
+                            mock_fetch.return_value.iter_content.return_value = [
+                                b"<html><body>Content</body></html>"
+                            ]
                             
                             with patch('trafilatura.extract') as mock_extract:
                                 # Return content > 100 chars
                                 mock_extract.return_value = "A" * 150
                                 
-                                with patch('time.sleep'):
+                                with patch('time.sleep'), \
+                                        patch('common.config.settings.SEARCH_EXTRACT_PROCESSES', 0):
                                     from search_worker.main import search_and_crawl
                                     results = search_and_crawl("test", max_results=1)
                                     
                                     assert len(results) >= 1
                                     assert results[0]["url"] == "https://example.com"
+
+    def test_throttled_fetch_spaces_same_host_only(self):
+        """Test repeat fetches from one host wait; other hosts don't."""
+        with patch('common.database.create_engine'):
+            import search_worker.main as search_main
+
+        search_main._host_next_fetch.clear()
+        with patch('requests.Session.get'), \
+                patch.object(search_main.time, 'sleep') as mock_sleep:
+            search_main.throttled_fetch("https://a.example/1")
+            search_main.throttled_fetch("https://b.example/1")
+            mock_sleep.assert_not_called()
+
+            search_main.throttled_fetch("https://a.example/2")
+            mock_sleep.assert_called_once()
+            assert 0 < mock_sleep.call_args[0][0] <= search_main.CRAWL_HOST_DELAY_S
+
+            # A waiting fetch has already reserved its slot: the next one queues behind it
+            search_main.throttled_fetch("https://a.example/3")
+            assert search_main.CRAWL_HOST_DELAY_S < mock_sleep.call_args[0][0] <= 2 * search_main.CRAWL_HOST_DELAY_S
+
+        assert len(search_main._host_next_fetch) == 2
+
+    def test_extract_runs_in_process_pool(self):
+        """Test extraction in a pool process returns the page's main text."""
+        with patch('common.database.create_engine'):
+            import search_worker.main as search_main
+
+        html = "<html><body><article><p>" + "본문 내용입니다. " * 40 + "</p></article></body></html>"
+        with patch.object(search_main.settings, 'SEARCH_EXTRACT_PROCESSES', 1):
+            text = search_main.run_extract(html.encode())
+            pool = search_main.get_extract_pool()
+            assert search_main.get_extract_pool() is pool
+            search_main.shutdown_extract_pool()
+
+        assert "본문 내용입니다." in text
+
+    def test_crawl_caches_extracted_content(self):
+        """Test a URL's extracted text is reused instead of re-crawled."""
+        with patch('common.database.create_engine'):
+            import search_worker.main as search_main
+
+        search_main._content_cache.clear()
+        with patch.object(search_main, 'extract_page', return_value="A" * 150) as mock_extract:
+            assert search_main.crawl("https://example.com/cached") == "A" * 150
+            assert search_main.crawl("https://example.com/cached") == "A" * 150
+
+        mock_extract.assert_called_once()
+
+    def test_filter_results_skips_duplicates_denylist_and_files(self):
+        """Test only distinct, crawlable result URLs are kept."""
+        with patch('common.database.create_engine'):
+            from search_worker.main import filter_results
+
+        urls = [
+            "https://news.example.com/article?id=1",
+            "https://www.news.example.com/article/?id=1#comments",
+            "https://news.example.com/article?id=2",
+            "https://m.youtube.com/watch?v=abc",
+            "https://example.com/report.PDF",
+        ]
+        kept = filter_results([{"url": url, "title": ""} for url in urls])
+
+        assert [r["url"] for r in kept] == [
+            "https://news.example.com/article?id=1",
+            "https://news.example.com/article?id=2",
+        ]
+
+
+class TestHandleRequest:
+    """Tests for the per-task search handler."""
+
+    def test_unclaimed_request_is_skipped(self):
+        """Test a request another worker holds is neither searched nor handed off."""
+        with patch('common.database.create_engine'):
+            import search_worker.main as search_main
+
+        db = MagicMock()
+        db.execute.return_value.fetchone.return_value = None
+        db.execute.return_value.scalar_one_or_none.return_value = "searching"
+        producer = MagicMock()
+
+        with patch.object(search_main, 'SessionLocal') as mock_session_local, \
+                patch.object(search_main, 'search_and_crawl') as mock_search:
+            mock_session_local.return_value.__enter__.return_value = db
+            search_main.handle_request({"request_id": "abc", "topic": "t"}, producer)
+
+        mock_search.assert_not_called()
+        producer.send_data.assert_not_called()
+        db.commit.assert_not_called()
+
+    def test_read_body_stops_at_limit(self):
+        """Test a streamed body is cut (and its connection closed) at the byte limit."""
+        with patch('common.database.create_engine'):
+            from search_worker.main import read_body
+
+        response = MagicMock()
+        response.iter_content.return_value = iter([b"a" * 4, b"b" * 4, b"c" * 4])
+
+        assert read_body(response, limit=6) == b"aaaabb"
+        response.close.assert_called_once()
+
+    def test_not_modified_page_reuses_content(self):
+        """Test an expired page is re-fetched conditionally and a 304 skips extraction."""
+        with patch('common.database.create_engine'):
+            import search_worker.main as search_main
+
+        url = "https://example.com/etag"
+        search_main._validator_cache[url] = ('"v1"', None, "B" * 150)
+        with patch('requests.Session.get') as mock_get, \
+                patch.object(search_main, 'run_extract') as mock_extract:
+            mock_get.return_value.status_code = 304
+            assert search_main.extract_page(url) == "B" * 150
+
+        assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+        mock_extract.assert_not_called()
+
+    def test_response_closed_when_read_fails(self):
+        """Test the streamed response is closed when reading the body raises."""
+        with patch('common.database.create_engine'):
+            import search_worker.main as search_main
+
+        with patch('requests.Session.get') as mock_get:
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.iter_content.side_effect = ConnectionError("reset")
+            assert search_main.extract_page("https://reset.example/page") == ""
+
+        mock_get.return_value.close.assert_called_once()
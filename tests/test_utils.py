@@ -0,0 +1,186 @@
+"""
+Unit tests for Kafka wrapper utilities.
+Uses mocking to avoid actual Kafka connections.
+"""
+import pytest
+from unittest.mock import MagicMock
+import sys
+import os
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+def make_message(partition, offset, topic="ai-queue"):
+    """Create a fake Kafka ConsumerRecord."""
+    message = MagicMock()
+    message.topic = topic
+    message.partition = partition
+    message.offset = offset
+    return message
+
+
+class TestKafkaProducerWrapper:
+    """Tests for KafkaProducerWrapper configuration."""
+
+    def test_producer_batching_config(self):
+        """Test the producer is created with batching, lz4 and integer acks."""
+        from unittest.mock import patch
+        from common.utils import KafkaProducerWrapper
+        from common.config import settings
+
+        with patch('common.utils.KafkaProducer') as mock_producer_class:
+            KafkaProducerWrapper()
+
+        kwargs = mock_producer_class.call_args.kwargs
+        assert kwargs["compression_type"] == "lz4"
+        assert kwargs["linger_ms"] == settings.KAFKA_LINGER_MS
+        assert kwargs["batch_size"] == settings.KAFKA_BATCH_SIZE
+        assert kwargs["acks"] == 1
+
+    def test_close_flushes_once(self):
+        """Test close flushes and closes the producer only on the first call."""
+        from unittest.mock import patch
+        from common.utils import KafkaProducerWrapper
+
+        with patch('common.utils.KafkaProducer') as mock_producer_class:
+            wrapper = KafkaProducerWrapper()
+            wrapper.close()
+            wrapper.close()
+
+        mock_producer_class.return_value.flush.assert_called_once_with(timeout=10)
+        mock_producer_class.return_value.close.assert_called_once()
+
+    def test_message_key_is_stable_and_short(self):
+        """Test equal topics map to the same 8-byte partition key."""
+        from common.utils import message_key
+
+        assert message_key("양자 컴퓨터") == message_key("양자 컴퓨터")
+        assert message_key("양자 컴퓨터") != message_key("AI 반도체")
+        assert len(message_key("x" * 1000)) == 8
+
+    def test_parse_acks(self):
+        """Test KAFKA_PRODUCER_ACKS strings map to kafka-python values."""
+        from common.utils import _parse_acks
+
+        assert _parse_acks("0") == 0
+        assert _parse_acks("1") == 1
+        assert _parse_acks("all") == "all"
+
+
+class TestKafkaConsumerWrapper:
+    """Tests for KafkaConsumerWrapper batching helpers."""
+
+    def test_commit_offsets_uses_highest_offset_per_partition(self, mock_kafka_consumer):
+        """Test offsets are committed as last offset + 1 for each partition."""
+        from common.utils import KafkaConsumerWrapper
+        from kafka import TopicPartition
+
+        wrapper = KafkaConsumerWrapper(topic="ai-queue", group_id="ai-group")
+        wrapper.commit_offsets([
+            make_message(0, 5),
+            make_message(0, 7),
+            make_message(1, 2),
+        ])
+
+        offsets = mock_kafka_consumer.commit.call_args[0][0]
+        assert offsets[TopicPartition("ai-queue", 0)].offset == 8
+        assert offsets[TopicPartition("ai-queue", 1)].offset == 3
+
+    def test_fetch_options_passed_to_consumer(self):
+        """Test the high-throughput preset reaches KafkaConsumer."""
+        from unittest.mock import patch
+        from common.utils import KafkaConsumerWrapper
+
+        with patch('common.utils.KafkaConsumer') as mock_consumer_class:
+            KafkaConsumerWrapper(
+                topic="topic_raw", group_id="saver-group", **KafkaConsumerWrapper.HIGH_THROUGHPUT
+            )
+
+        kwargs = mock_consumer_class.call_args.kwargs
+        assert kwargs["fetch_min_bytes"] == 64 * 1024
+        assert kwargs["max_partition_fetch_bytes"] == 4 * 1024 * 1024
+        assert kwargs["max_poll_records"] == 256
+
+    def test_commit_offsets_empty_batch_is_noop(self, mock_kafka_consumer):
+        """Test nothing is committed for an empty batch."""
+        from common.utils import KafkaConsumerWrapper
+
+        wrapper = KafkaConsumerWrapper(topic="ai-queue", group_id="ai-group")
+        wrapper.commit_offsets([])
+
+        mock_kafka_consumer.commit.assert_not_called()
+
+    def test_commit_offsets_async_flushed_synchronously(self, mock_kafka_consumer):
+        """Test async commits are re-committed synchronously by flush_commits."""
+        from common.utils import KafkaConsumerWrapper
+        from kafka import TopicPartition
+
+        mock_kafka_consumer.assignment.return_value = {TopicPartition("ai-queue", 0)}
+        wrapper = KafkaConsumerWrapper(topic="ai-queue", group_id="ai-group")
+        wrapper.commit_offsets([make_message(0, 3)], asynchronous=True)
+        wrapper.commit_offsets([make_message(0, 4)], asynchronous=True)
+
+        assert mock_kafka_consumer.commit_async.call_count == 2
+        mock_kafka_consumer.commit.assert_not_called()
+
+        wrapper.flush_commits()
+
+        offsets = mock_kafka_consumer.commit.call_args[0][0]
+        assert offsets[TopicPartition("ai-queue", 0)].offset == 5
+
+        wrapper.flush_commits()
+        assert mock_kafka_consumer.commit.call_count == 1
+
+    def test_flush_commits_skips_revoked_partitions(self, mock_kafka_consumer):
+        """Test the exit commit only covers partitions still assigned."""
+        from common.utils import KafkaConsumerWrapper
+        from kafka import TopicPartition
+
+        wrapper = KafkaConsumerWrapper(topic="ai-queue", group_id="ai-group")
+        wrapper.commit_offsets([make_message(0, 3), make_message(1, 7)], asynchronous=True)
+        # Partition 1 was revoked by a rebalance
+        mock_kafka_consumer.assignment.return_value = {TopicPartition("ai-queue", 0)}
+
+        wrapper.flush_commits()
+
+        offsets = mock_kafka_consumer.commit.call_args[0][0]
+        assert set(offsets) == {TopicPartition("ai-queue", 0)}
+
+    def test_get_batches_flattens_poll_records(self, mock_kafka_consumer):
+        """Test get_batches yields one flat list per poll."""
+        from common.utils import KafkaConsumerWrapper
+
+        mock_kafka_consumer.poll.return_value = {
+            "tp0": [make_message(0, 1)],
+            "tp1": [make_message(1, 1), make_message(1, 2)],
+        }
+
+        wrapper = KafkaConsumerWrapper(topic="ai-queue", group_id="ai-group")
+        batch = next(wrapper.get_batches(max_records=8, timeout_ms=10))
+
+        assert len(batch) == 3
+        mock_kafka_consumer.poll.assert_called_with(timeout_ms=10, max_records=8)
+
+
+class TestSetupLogging:
+    """Tests for the queue-based logging helper."""
+
+    def test_setup_logging_installs_queue_handler_once(self):
+        """Test repeated calls share one QueueHandler on the root logger."""
+        import logging
+        from logging.handlers import QueueHandler
+        import common.utils as utils
+
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        try:
+            logger = utils.setup_logging("ai_worker")
+            utils.setup_logging("search_worker")
+
+            assert logger.name == "ai_worker"
+            queue_handlers = [h for h in root.handlers if isinstance(h, QueueHandler)]
+            assert len(queue_handlers) == 1
+        finally:
+            root.handlers[:] = handlers
+            root.setLevel(level)